@@ -0,0 +1,275 @@
+import os
+import queue
+import traceback
+import multiprocessing
+
+import cv2
+
+import pipeline
+import hands_detector
+import landmark_store
+import frame_reader
+import result_writer
+from const import ANALYSIS_OPTIONS, VIDEO_ENCODE_PRESETS
+
+
+class InvalidVideoError(Exception):
+    """動画ファイルが読み込めないことを表す例外
+    """
+
+
+class SegmentFailedError(Exception):
+    """並行して解析している区間の解析に失敗したことを表す例外
+    """
+
+
+def analyze_video(video_path, outdir, detector, callback=None, options=None,
+                  segments=1, detector_factory=hands_detector.HandsDetector, metrics=None, preview=None):
+    """動画の解析
+
+    解析結果として、出力先フォルダに result.mp4 と result.json、
+    配列形式の解析結果(landmarksフォルダ)を作成する。
+    (解析の設定で動画を作成しないようにした場合は、result.mp4 は作成しない)
+    途中で中断した場合は、次回の解析で完了した区間の続きから再開する。
+
+    segmentsが2以上の場合は、未完了の区間をsegments個に分け、
+    それぞれ別のプロセスで専用のAIモデルを作成して並行して解析する。
+    各プロセスは担当する区間の先頭にシークしてから解析を始め、
+    区間ごとの途中ファイル(JSONと動画)を書き出す。
+    最後に途中ファイルを連結する(動画は再エンコードしない)。
+
+    Args:
+        video_path (str):
+            動画ファイルのパス
+        outdir (str):
+            解析結果の出力先フォルダ
+        detector (hands_detector.HandsDetector):
+            AIモデル
+        callback (function(int, int) or None):
+            1フレームの処理が完了するたびに(フレーム番号, フレーム数)で呼ばれる関数
+        options (dict or None):
+            解析の設定(ANALYSIS_OPTIONSと同じ形式。Noneの場合は初期値)
+        segments (int):
+            並行して解析するプロセス数
+        detector_factory (function):
+            各プロセスでAIモデルを作成する関数(detector.optionsの設定で呼ばれる)
+        metrics (metrics.PipelineMetrics or None):
+            ステージごとの処理時間の記録先(複数のプロセスで解析する場合は記録しない)
+        preview (function(int, ndarray) or None):
+            一定のフレーム間隔で(フレーム番号, 縮小した描画画像)で呼ばれる関数
+            (複数のプロセスで解析する場合は呼ばれない)
+
+    Returns:
+        なし
+
+    Raises:
+        InvalidVideoError: 動画ファイルが読み込めない場合
+        SegmentFailedError: 並行して解析している区間の解析に失敗した場合
+    """
+    cap = cv2.VideoCapture(video_path)
+    try:
+        # 動画ファイルのチェック
+        ret, emsg = validate_video(cap)
+        if ret is False:
+            raise InvalidVideoError(emsg)
+        nframe, shape, fps = get_video_info(cap)
+    finally:
+        cap.release()
+
+    if os.path.exists(outdir) is False:
+        os.mkdir(outdir)
+    # 前回中断した解析があれば、その続きから再開する
+    sink = result_writer.ChunkedResultWriter(
+        outdir, video_path, nframe, fps, shape, detector.options["num_hands"], options,
+        detector_options=detector.options, metrics=metrics)
+
+    list_ranges = sink.pending_ranges(segments)
+    if len(list_ranges) > 1:
+        _analyze_parallel(
+            video_path, outdir, nframe, fps, shape, detector, detector_factory,
+            options, sink, list_ranges, callback)
+        sink.finish()
+        return
+
+    # 解析実行
+    # デコード・検出・描画・エンコードを並行して処理する
+    # (並行して解析した後の再開では、未完了の区間が飛び飛びになっている場合がある)
+    for start, stop in list_ranges[0] if list_ranges else []:
+        reader = frame_reader.FrameReader(video_path)
+        try:
+            analysis = pipeline.AnalysisPipeline(reader, detector, sink, options, metrics=metrics, preview=preview)
+            try:
+                analysis.run(
+                    start, stop,
+                    callback=None if callback is None else lambda iframe, _: callback(iframe, nframe))
+            except BaseException:
+                # 完了した区間は残し、書き込み中の区間のみ破棄する
+                sink.abort()
+                raise
+        finally:
+            reader.close()
+    # 区間ごとの結果を連結する
+    sink.finish()
+
+
+def _analyze_parallel(video_path, outdir, nframe, fps, shape, detector, detector_factory,
+                      options, sink, list_ranges, callback):
+    """複数のプロセスで区間を分担して解析する
+
+    完了した区間は各プロセスから通知を受けてチェックポイントに記録する。
+    いずれかのプロセスが失敗した場合は、すべてのプロセスを止める。
+
+    Args:
+        video_path (str): 動画ファイルのパス
+        outdir (str): 解析結果の出力先フォルダ
+        nframe (int): フレーム数
+        fps (float): フレームレート
+        shape (tuple(int, int)): (幅, 高さ)
+        detector (hands_detector.HandsDetector): AIモデル(設定のみ使う)
+        detector_factory (function): 各プロセスでAIモデルを作成する関数
+        options (dict or None): 解析の設定
+        sink (result_writer.ChunkedResultWriter): 解析結果の書き込み先
+        list_ranges (list(list(tuple(int, int)))): プロセスごとの解析する区間
+        callback (function(int, int) or None): 進捗を通知する関数
+
+    Raises:
+        SegmentFailedError: いずれかのプロセスで解析に失敗した場合
+    """
+    # 解析結果に影響する設定のうち、モデルファイルのハッシュ以外をAIモデルの作成に使う
+    detector_kwargs = {
+        key: value for key, value in detector.options.items() if key != "model_sha256"
+    }
+    # 子プロセスが配列形式の解析結果を開く前に、ファイルを作成しておく
+    sink.store.flush()
+    # 処理済みのフレーム数
+    processed = sum(
+        min(start + sink.chunk_size, nframe) - start
+        for start in sink.checkpoint["completed_chunks"])
+
+    # 子プロセスにスレッドの状態を引き継がないように spawn で起動する
+    context = multiprocessing.get_context("spawn")
+    messages = context.Queue()
+    processes = [
+        context.Process(
+            target=_analyze_segment,
+            args=(video_path, outdir, nframe, fps, shape, detector_factory, detector_kwargs,
+                  options, sink.chunk_size, ranges, messages),
+            daemon=True)
+        for ranges in list_ranges
+    ]
+    for process in processes:
+        process.start()
+    try:
+        running = len(processes)
+        while running > 0:
+            try:
+                message = messages.get(timeout=1.0)
+            except queue.Empty:
+                # 通知せずに終了したプロセス(強制終了など)がないか確認する
+                if any(process.exitcode not in (None, 0) for process in processes):
+                    raise SegmentFailedError("解析プロセスが異常終了しました")
+                continue
+            if message[0] == "frame":
+                processed += 1
+                if callback is not None:
+                    callback(processed - 1, nframe)
+            elif message[0] == "chunk":
+                sink.complete_chunk(message[1])
+            elif message[0] == "done":
+                running -= 1
+            elif message[0] == "error":
+                raise SegmentFailedError(message[1])
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def _analyze_segment(video_path, outdir, nframe, fps, shape, detector_factory, detector_kwargs,
+                     options, chunk_size, ranges, messages):
+    """子プロセスで担当する区間を解析する
+
+    Args:
+        video_path (str): 動画ファイルのパス
+        outdir (str): 解析結果の出力先フォルダ
+        nframe (int): フレーム数
+        fps (float): フレームレート
+        shape (tuple(int, int)): (幅, 高さ)
+        detector_factory (function): AIモデルを作成する関数
+        detector_kwargs (dict): AIモデルの設定
+        options (dict or None): 解析の設定
+        chunk_size (int): 1区間のフレーム数
+        ranges (list(tuple(int, int))): 解析する(最初のフレーム番号, 最後のフレーム番号+1)
+        messages (multiprocessing.Queue): 親プロセスへの通知
+    """
+    sink = None
+    try:
+        options = dict(ANALYSIS_OPTIONS, **(options or {}))
+        encode = VIDEO_ENCODE_PRESETS[options["video"]] if options["video"] else None
+        detector = detector_factory(**detector_kwargs)
+        # 他のプロセスと同じファイルの別のフレームに書き込む
+        store = landmark_store.LandmarkStoreWriter(
+            outdir, nframe, detector_kwargs["num_hands"], shape, resume=True)
+        sink = result_writer.SegmentWriter(
+            outdir, store, fps, shape, encode, chunk_size,
+            on_chunk_done=lambda start: messages.put(("chunk", start)))
+        for start, stop in ranges:
+            reader = frame_reader.FrameReader(video_path)
+            try:
+                analysis = pipeline.AnalysisPipeline(reader, detector, sink, options)
+                analysis.run(start, stop, callback=lambda iframe, nframe: messages.put(("frame", iframe)))
+            finally:
+                reader.close()
+            sink.close()
+        messages.put(("done",))
+    except BaseException:
+        if sink is not None:
+            sink.abort()
+        messages.put(("error", traceback.format_exc()))
+
+
+def validate_video(cap):
+    """動画ファイルのチェック
+
+    Args:
+        cap (cv2.VideoCapture):
+            ビデオキャプチャーオブジェクト
+
+    Returns:
+        bool:
+            チェックの結果
+        str or None:
+            エラーメッセージ
+    """
+    emsg = \
+        "動画ファイルの読み込みに失敗しました。  \n" + \
+        "ファイル形式がサポートされていないか、ファイル拡張子が正しくないか、" + \
+        "ファイルが破損している可能性があります。"
+    if cap.isOpened() is False:
+        return False, emsg
+
+    nframe = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if nframe <= 0:
+        return False, emsg
+
+    return True, None
+
+
+def get_video_info(cap):
+    """動画情報の取得
+
+    Args:
+        cap (cv2.VideoCapture):
+            ビデオキャプチャーオブジェクト
+
+    Returns:
+        int: フレーム数
+        tuple(int. int): 幅,高さ
+        float: フレームレート
+    """
+    nframe = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    return nframe, (width, height), fps
@@ -0,0 +1,439 @@
+"""解析のベンチマーク
+
+Streamlitやネットワークを使わずに、コマンドラインから実行する。
+
+- scales: 推論する画像の長辺の最大値(max_side)を変えて同じ動画を解析し、
+  1フレームあたりの推論時間と、縮小しない場合の結果に対する誤差を比較する。
+- generate: ベンチマーク用の合成動画を作成する。
+- pipeline: 解析パイプライン(読み込み → 推論 → 描画 → 書き込み)を実行し、
+  全体のフレームレート、ステージごとの処理時間、メモリ使用量の最大値を計測する。
+  結果はJSONまたはCSVで出力し、コミットごとに比較できるようにコミットのハッシュ値も記録する。
+
+使い方:
+    python benchmark.py scales 動画ファイル [--max-sides 0 1280 960 640 480] [--frames 300]
+    python benchmark.py generate 出力ファイル [--width 1280] [--height 720] [--frames 300] [--fps 30]
+    python benchmark.py pipeline [--video 動画ファイル] [--width 1280] [--height 720] [--frames 300]
+        [--detect-interval 1] [--adaptive] [--video-preset preview] [--report report.json or report.csv]
+"""
+import os
+import csv
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+import cv2
+import numpy as np
+
+import pipeline
+import frame_reader
+import video_writer
+import result_writer
+import hands_detector
+import frame_sampler
+from const import DETECTOR_RUNNING_MODE, INFERENCE_MAX_SIDE, ANALYSIS_OPTIONS, VIDEO_ENCODE_PRESETS
+
+
+def run_detector(video_path, detector, max_frames=None):
+    """動画の先頭から推論し、推論結果と推論時間を返す
+
+    Args:
+        video_path (str): 動画ファイルのパス
+        detector (hands_detector.HandsDetector): 手のひら検知
+        max_frames (int or None): 推論するフレーム数の上限
+
+    Returns:
+        list(tuple(ndarray, ndarray, ndarray)): フレームごとの解析結果の配列
+        ndarray((フレーム数,), dtype=np.float64): フレームごとの推論時間[秒]
+        tuple(int, int): 動画の(幅, 高さ)
+    """
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    shape = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    list_hands = []
+    list_seconds = []
+    detector.reset()
+    try:
+        iframe = 0
+        while max_frames is None or iframe < max_frames:
+            ret, image = cap.read()
+            if ret is False:
+                break
+            image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            start = time.perf_counter()
+            detection_result = detector.infer(image_rgb, round(iframe * 1000 / fps))
+            list_seconds.append(time.perf_counter() - start)
+            list_hands.append(detector.to_arrays(detection_result))
+            iframe += 1
+    finally:
+        cap.release()
+    return list_hands, np.array(list_seconds, dtype=np.float64), shape
+
+
+def compare(reference, list_hands, shape):
+    """基準の解析結果との比較
+
+    左右で対応づけた手の関節点の距離と、検出した手の数が一致したフレームの割合を求める
+
+    Args:
+        reference (list(tuple)): 基準とするフレームごとの解析結果の配列
+        list_hands (list(tuple)): 比較するフレームごとの解析結果の配列
+        shape (tuple(int, int)): 動画の(幅, 高さ)
+
+    Returns:
+        float: 関節点の平均誤差[pixel](対応する手がない場合はNaN)
+        float: 検出した手の数が一致したフレームの割合
+    """
+    size = np.array(shape, dtype=np.float64)
+    errors = []
+    nmatched = 0
+    for hands_ref, hands in zip(reference, list_hands):
+        if len(hands_ref[0]) == len(hands[0]):
+            nmatched += 1
+        for iref, ihand in frame_sampler.match_hands(hands_ref, hands):
+            diff = (hands[0][ihand, :, :2] - hands_ref[0][iref, :, :2]) * size
+            errors.extend(np.linalg.norm(diff, axis=1).tolist())
+    error = float(np.mean(errors)) if errors else float("nan")
+    return error, nmatched / max(len(reference), 1)
+
+
+def benchmark_scales(video_path, list_max_side, max_frames=None, running_mode=DETECTOR_RUNNING_MODE):
+    """推論解像度ごとのベンチマーク
+
+    Args:
+        video_path (str): 動画ファイルのパス
+        list_max_side (list(int or None)): 比較する長辺の最大値(Noneは縮小しない)
+        max_frames (int or None): 推論するフレーム数の上限
+        running_mode (str): 推論モード
+
+    Returns:
+        list(dict): 長辺の最大値ごとの結果
+    """
+    reference, seconds_ref, shape = run_detector(
+        video_path, hands_detector.HandsDetector(running_mode=running_mode, max_side=None), max_frames)
+    list_results = []
+    for max_side in list_max_side:
+        if max_side is None:
+            list_hands, seconds = reference, seconds_ref
+        else:
+            list_hands, seconds, _ = run_detector(
+                video_path, hands_detector.HandsDetector(running_mode=running_mode, max_side=max_side), max_frames)
+        error, agreement = compare(reference, list_hands, shape)
+        list_results.append({
+            "max_side": max_side,
+            "frames": len(seconds),
+            "mean_ms": float(seconds.mean() * 1000),
+            "p95_ms": float(np.percentile(seconds, 95) * 1000),
+            "speedup": float(seconds_ref.mean() / seconds.mean()),
+            "mean_error_px": error,
+            "agreement": agreement,
+        })
+    return list_results
+
+
+def generate_video(filename, width=1280, height=720, nframe=300, fps=30, codec="h264"):
+    """ベンチマーク用の合成動画の作成
+
+    グラデーションの背景の上を複数の円が動く動画を作成する。
+    手は映っていないため、推論モードが"video"でもトラッキングは働かず、
+    毎フレーム手のひら検出が実行される(推論時間としては最も遅い場合になる)。
+
+    Args:
+        filename (str): 出力する動画ファイル名
+        width (int): 幅
+        height (int): 高さ
+        nframe (int): フレーム数
+        fps (float): フレームレート
+        codec (str): コーデック
+
+    Returns:
+        なし
+    """
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    background = np.empty((height, width, 3), dtype=np.uint8)
+    background[:, :, 0] = x[None, :]
+    background[:, :, 1] = y[:, None]
+    background[:, :, 2] = 128
+    radius = max(4, min(width, height) // 10)
+    with video_writer.VideoWriter(filename, codec, fps, (width, height)) as writer:
+        for iframe in range(nframe):
+            image = background.copy()
+            for i in range(3):
+                t = iframe / max(fps, 1) + i * 2.1
+                center = (
+                    int(width * (0.5 + 0.35 * np.sin(t * (0.7 + 0.2 * i)))),
+                    int(height * (0.5 + 0.35 * np.cos(t * (0.9 + 0.1 * i)))))
+                cv2.circle(image, center, radius, (255 - 80 * i, 60 * i, 200), -1)
+            writer.write(image)
+
+
+class StageTimer():
+    """ステージごとの処理時間の記録
+
+    AnalysisPipeline の metrics に渡す
+    """
+    def __init__(self):
+        # ステージ名 => 処理時間[秒]のリスト
+        # (動画を作成しない場合も、CSVの列が揃うように動画のエンコードのステージを含める)
+        self.seconds = {stage: [] for stage in pipeline.STAGES + [video_writer.STAGE]}
+
+    def add(self, stage, seconds):
+        """処理時間の追加
+
+        Args:
+            stage (str): ステージ名
+            seconds (float): 処理時間[秒]
+
+        Returns:
+            なし
+        """
+        # list.appendはスレッドセーフのため、ロックは不要
+        self.seconds.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        """ステージごとの集計
+
+        Returns:
+            dict: ステージ名 => {"count", "total_s", "mean_ms", "p50_ms", "p95_ms"}
+        """
+        dict_summary = {}
+        for stage, list_seconds in self.seconds.items():
+            seconds = np.array(list_seconds, dtype=np.float64)
+            if len(seconds) == 0:
+                dict_summary[stage] = {"count": 0, "total_s": 0.0, "mean_ms": None, "p50_ms": None, "p95_ms": None}
+                continue
+            dict_summary[stage] = {
+                "count": len(seconds),
+                "total_s": float(seconds.sum()),
+                "mean_ms": float(seconds.mean() * 1000),
+                "p50_ms": float(np.percentile(seconds, 50) * 1000),
+                "p95_ms": float(np.percentile(seconds, 95) * 1000),
+            }
+        return dict_summary
+
+
+def benchmark_pipeline(video_path, detector, options=None):
+    """解析パイプラインのベンチマーク
+
+    解析結果は一時フォルダに書き出し、終了後に削除する
+
+    Args:
+        video_path (str): 動画ファイルのパス
+        detector (hands_detector.HandsDetector): 手のひら検知
+        options (dict or None): 解析の設定(ANALYSIS_OPTIONSと同じ形式)
+
+    Returns:
+        dict: 計測結果
+    """
+    options = dict(ANALYSIS_OPTIONS, **(options or {}))
+    cap = cv2.VideoCapture(video_path)
+    nframe = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    reader = frame_reader.FrameReader(video_path)
+    outdir = tempfile.mkdtemp(prefix="benchmark-")
+    timer = StageTimer()
+    rss_before = _peak_rss_mb()
+    try:
+        sink = result_writer.ChunkedResultWriter(
+            outdir, video_path, nframe, reader.fps, (reader.width, reader.height),
+            detector.options["num_hands"], options, metrics=timer)
+        analysis = pipeline.AnalysisPipeline(reader, detector, sink, options, metrics=timer)
+        start = time.perf_counter()
+        analysis.run(0, nframe)
+        sink.finish()
+        seconds = time.perf_counter() - start
+    finally:
+        reader.close()
+        shutil.rmtree(outdir, ignore_errors=True)
+    nprocessed = len(timer.seconds["encode"])
+    return {
+        "frames": nprocessed,
+        "width": reader.width,
+        "height": reader.height,
+        "wall_s": seconds,
+        "fps": nprocessed / seconds if seconds > 0 else None,
+        "peak_rss_mb": _peak_rss_mb(),
+        "peak_rss_before_mb": rss_before,
+        "stages": timer.summary(),
+    }
+
+
+def write_report(filename, report):
+    """計測結果の出力
+
+    拡張子が .csv の場合は1回の計測を1行として追記し、それ以外はJSONで書き出す。
+    CSVに追記する場合は、既存のヘッダーの列に合わせて書き込む(ない列は空欄)。
+
+    Args:
+        filename (str): 出力ファイル名
+        report (dict): 計測結果
+
+    Returns:
+        なし
+    """
+    if filename.endswith(".csv") is False:
+        with open(filename, "w") as f:
+            json.dump(report, f, indent=2)
+        return
+    row = {key: value for key, value in report.items() if isinstance(value, (dict, list)) is False}
+    for key, value in report["config"].items():
+        row["config_" + key] = value
+    for stage, dict_stage in report["result"]["stages"].items():
+        for key, value in dict_stage.items():
+            row[stage + "_" + key] = value
+    for key, value in report["result"].items():
+        if key != "stages":
+            row[key] = value
+    header = None
+    if os.path.exists(filename):
+        with open(filename, newline="") as f:
+            header = next(csv.reader(f), None)
+    with open(filename, "a", newline="") as f:
+        # 既存のヘッダーにない列がある場合は、列がずれないようにエラーにする
+        writer = csv.DictWriter(f, fieldnames=header or list(row), restval="")
+        if header is None:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def _git_commit():
+    """ソースコードのコミットのハッシュ値
+
+    Returns:
+        str or None: コミットのハッシュ値(変更がある場合は末尾に"-dirty"。gitがない場合はNone)
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=cwd,
+            capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=cwd,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + "-dirty" if status else commit
+
+
+def _peak_rss_mb():
+    """このプロセスのメモリ使用量(RSS)の最大値
+
+    Returns:
+        float: メモリ使用量の最大値[MB]
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    if sys.platform == "darwin":
+        return peak / 1024 ** 2
+    return peak / 1024
+
+
+def _main_scales(args):
+    list_max_side = [max_side if max_side > 0 else None for max_side in args.max_sides]
+    list_results = benchmark_scales(args.video, list_max_side, args.frames, args.running_mode)
+    print("%8s %7s %9s %9s %8s %10s %10s" % (
+        "max_side", "frames", "mean[ms]", "p95[ms]", "speedup", "error[px]", "agreement"))
+    for result in list_results:
+        print("%8s %7d %9.2f %9.2f %8.2f %10.2f %10.3f" % (
+            result["max_side"] or "-", result["frames"], result["mean_ms"], result["p95_ms"],
+            result["speedup"], result["mean_error_px"], result["agreement"]))
+
+
+def _main_generate(args):
+    generate_video(args.output, args.width, args.height, args.frames, args.fps)
+
+
+def _main_pipeline(args):
+    options = {
+        "detect_interval": args.detect_interval,
+        "adaptive": args.adaptive,
+        "video": None if args.video_preset == "none" else args.video_preset,
+    }
+    tmpdir = None
+    video_path = args.video
+    if video_path is None:
+        tmpdir = tempfile.mkdtemp(prefix="benchmark-")
+        video_path = tmpdir + "/synthetic.mp4"
+        generate_video(video_path, args.width, args.height, args.frames, args.fps)
+    try:
+        max_side = args.max_side if args.max_side > 0 else None
+        detector = hands_detector.HandsDetector(running_mode=args.running_mode, max_side=max_side)
+        result = benchmark_pipeline(video_path, detector, options)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "video": args.video or "synthetic",
+        "config": dict(options, running_mode=args.running_mode, max_side=max_side),
+        "result": result,
+    }
+    print("%d frames (%dx%d) in %.2f s: %.2f fps, peak RSS %.1f MB" % (
+        result["frames"], result["width"], result["height"], result["wall_s"],
+        result["fps"] or 0.0, result["peak_rss_mb"]))
+    print("%8s %7s %9s %9s %9s" % ("stage", "count", "mean[ms]", "p50[ms]", "p95[ms]"))
+    for stage, dict_stage in result["stages"].items():
+        if dict_stage["count"] == 0:
+            continue
+        print("%8s %7d %9.2f %9.2f %9.2f" % (
+            stage, dict_stage["count"], dict_stage["mean_ms"], dict_stage["p50_ms"], dict_stage["p95_ms"]))
+    if args.report is not None:
+        write_report(args.report, report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="解析のベンチマーク")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_scales = subparsers.add_parser("scales", help="推論解像度ごとの推論時間と誤差の比較")
+    parser_scales.add_argument("video", help="動画ファイルのパス")
+    parser_scales.add_argument(
+        "--max-sides", type=int, nargs="+", default=[0, 1280, 960, 640, 480],
+        help="比較する長辺の最大値[pixel](0は縮小しない)")
+    parser_scales.add_argument("--frames", type=int, default=300, help="推論するフレーム数の上限")
+    parser_scales.add_argument(
+        "--running-mode", choices=["video", "image"], default=DETECTOR_RUNNING_MODE, help="推論モード")
+    parser_scales.set_defaults(func=_main_scales)
+
+    parser_generate = subparsers.add_parser("generate", help="合成動画の作成")
+    parser_generate.add_argument("output", help="出力する動画ファイル名")
+    parser_pipeline = subparsers.add_parser("pipeline", help="解析パイプラインの計測")
+    parser_pipeline.add_argument("--video", default=None, help="動画ファイルのパス(省略した場合は合成動画)")
+    for subparser in [parser_generate, parser_pipeline]:
+        subparser.add_argument("--width", type=int, default=1280, help="合成動画の幅")
+        subparser.add_argument("--height", type=int, default=720, help="合成動画の高さ")
+        subparser.add_argument("--frames", type=int, default=300, help="合成動画のフレーム数")
+        subparser.add_argument("--fps", type=float, default=30, help="合成動画のフレームレート")
+    parser_generate.set_defaults(func=_main_generate)
+
+    parser_pipeline.add_argument("--detect-interval", type=int, default=1, help="推論するフレームの間隔")
+    parser_pipeline.add_argument("--adaptive", action="store_true", help="手の動きに応じて推論の間隔を決める")
+    parser_pipeline.add_argument(
+        "--video-preset", choices=list(VIDEO_ENCODE_PRESETS) + ["none"], default="preview",
+        help="出力動画のエンコード設定(noneの場合は動画を作成しない)")
+    parser_pipeline.add_argument(
+        "--running-mode", choices=["video", "image"], default=DETECTOR_RUNNING_MODE, help="推論モード")
+    parser_pipeline.add_argument(
+        "--max-side", type=int, default=INFERENCE_MAX_SIDE or 0,
+        help="推論する画像の長辺の最大値[pixel](0は縮小しない)")
+    parser_pipeline.add_argument(
+        "--report", default=None, help="計測結果の出力先(.csvの場合はCSVに追記、それ以外はJSON)")
+    parser_pipeline.set_defaults(func=_main_pipeline)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
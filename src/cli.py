@@ -0,0 +1,263 @@
+"""コマンドラインからの一括解析
+
+Streamlitを使わずに、複数の動画ファイルをまとめて解析する。
+解析結果は画面から解析した場合と同じく、解析結果の保存先の「動画ファイル名(拡張子なし)」フォルダに
+result.json、result.mp4、配列形式の解析結果(landmarksフォルダ)として保存するため、
+画面の「解析結果の確認とダウンロード」でも確認できる。
+1つでも解析に失敗した動画があれば、終了コード1で終了する。
+
+使い方:
+    python3 cli.py 動画ファイル or ワイルドカード ... [--workers 2] [--segments 1]
+        [--detect-interval 1] [--adaptive] [--video-preset preview] [--results-dir ./results/]
+        [--cache-dir ./results/.cache/] [--no-cache]
+
+例:
+    python3 cli.py "/data/recordings/*.mp4" --workers 4 --video-preset none
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import analyzer
+import metrics
+import media_index
+import result_cache
+import result_writer
+import job_manager
+import detector_pool
+import hands_detector
+from const import RESULTS_DIR, CACHE_DIR, ANALYSIS_OPTIONS, VIDEO_ENCODE_PRESETS
+
+
+def expand_inputs(list_patterns):
+    """入力の動画ファイルの一覧の作成
+
+    ワイルドカードを含む場合は一致するファイルに展開する(シェルで展開されなかった場合のため)
+
+    Args:
+        list_patterns (list(str)): 動画ファイルのパス or ワイルドカード
+
+    Returns:
+        list(str): 動画ファイルのパス(重複なし・指定順)
+
+    Raises:
+        ValueError: 結果のフォルダ名(動画ファイル名)が重複する場合
+    """
+    list_paths = []
+    for pattern in list_patterns:
+        if glob.has_magic(pattern):
+            list_paths.extend(sorted(glob.glob(pattern)))
+        else:
+            list_paths.append(pattern)
+    list_paths = list(dict.fromkeys(list_paths))
+
+    names = {}
+    for path in list_paths:
+        name = result_name(path)
+        if name in names:
+            raise ValueError("結果のフォルダ名が重複します: %s, %s" % (names[name], path))
+        names[name] = path
+    return list_paths
+
+
+def result_name(video_path):
+    """動画ファイルの結果のフォルダ名
+
+    Args:
+        video_path (str): 動画ファイルのパス
+
+    Returns:
+        str: 結果のフォルダ名(動画ファイル名から拡張子を除いたもの)
+    """
+    return os.path.basename(video_path).rsplit(".", maxsplit=1)[0]
+
+
+def analyze_one(video_path, pool, options, results_dir=RESULTS_DIR, segments=1, cache=None):
+    """1つの動画の解析
+
+    AIモデルはプールから借りて、解析が終わったら返す
+
+    Args:
+        video_path (str): 動画ファイルのパス
+        pool (detector_pool.DetectorPool): AIモデルのプール
+        options (dict): 解析の設定(ANALYSIS_OPTIONSと同じ形式)
+        results_dir (str): 解析結果の保存先
+        segments (int): 動画を分割して並行して解析するプロセス数
+        cache (result_cache.ResultCache or None): 解析結果のキャッシュ(Noneの場合は使わない)
+
+    Returns:
+        bool: キャッシュの結果を使ったかどうか
+
+    Raises:
+        job_manager.JobConflictError: 画面から投入した同じ名前の解析ジョブが待機中・実行中の場合
+        解析で発生した例外
+    """
+    name = result_name(video_path)
+    outdir = results_dir + name
+    # 画面から投入したジョブが書き込んでいる結果フォルダには書き込まない
+    # (前回の起動時に完了しなかったジョブも、次回の起動時に再開されるため対象とする)
+    job = _read_job(outdir)
+    if job is not None and job.get("status") in (job_manager.QUEUED, job_manager.RUNNING):
+        raise job_manager.JobConflictError("画面から投入した解析ジョブが待機中・実行中です: %s" % name)
+    # 画面から解析したときのジョブの状態・以前の解析の処理速度は残さない
+    for filename in [outdir + "/" + job_manager.JOB_FILE, outdir + "/" + metrics.METRICS_FILE]:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    # 同じ動画を同じ設定で解析済みであれば、保存済みの結果を使う
+    key = None
+    if cache is not None:
+        key = cache.key(media_index.video_sha256(video_path), dict(pool.options, **options))
+        if cache.lookup(key, outdir):
+            _register_result(results_dir, name, video_path)
+            return True
+
+    ticket = pool.request()
+    detector = pool.acquire(ticket)
+    try:
+        job_metrics = metrics.PipelineMetrics()
+        analyzer.analyze_video(
+            video_path, outdir, detector,
+            callback=lambda iframe, nframe: job_metrics.frame_done(iframe + 1, nframe),
+            options=options, segments=segments, metrics=job_metrics)
+        result_writer.write_json_atomic(outdir + "/" + metrics.METRICS_FILE, job_metrics.snapshot())
+    finally:
+        pool.release(detector)
+    if cache is not None:
+        cache.store(key, outdir)
+    _register_result(results_dir, name, video_path)
+    return False
+
+
+def _read_job(outdir):
+    """結果フォルダのジョブの状態の読み込み
+
+    Args:
+        outdir (str): 結果フォルダのパス
+
+    Returns:
+        dict or None: ジョブの状態(ジョブの状態ファイルがない場合・読めない場合はNone)
+    """
+    try:
+        with open(outdir + "/" + job_manager.JOB_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _register_result(results_dir, name, video_path):
+    """解析結果の索引への登録
+
+    結果の確認画面で動画を開かずに済むように、動画情報も記録する
+
+    Args:
+        results_dir (str): 解析結果の保存先
+        name (str): 結果のフォルダ名
+        video_path (str): 動画ファイルのパス
+    """
+    info = media_index.probe_video(video_path)
+    media_index.update_entry(
+        results_dir, name,
+        status=job_manager.DONE, video=os.path.basename(video_path),
+        has_video=os.path.exists(results_dir + name + "/result.mp4"),
+        **{key: info[key] for key in ("nframe", "fps", "width", "height", "duration")})
+
+
+def run(list_paths, workers=1, options=None, results_dir=RESULTS_DIR, segments=1, cache_dir=CACHE_DIR,
+        factory=hands_detector.HandsDetector, log=print):
+    """複数の動画の解析
+
+    workers個の動画を同時に解析する(動画ごとに別のAIモデルを使う)
+
+    Args:
+        list_paths (list(str)): 動画ファイルのパス
+        workers (int): 同時に解析する動画の数
+        options (dict or None): 解析の設定(ANALYSIS_OPTIONSと同じ形式)
+        results_dir (str): 解析結果の保存先
+        segments (int): 1つの動画を分割して並行して解析するプロセス数
+        cache_dir (str or None): 解析結果のキャッシュの保存先(Noneの場合はキャッシュを使わない)
+        factory (function): AIモデルを作成する関数
+        log (function(str)): 進捗の出力先
+
+    Returns:
+        list(str): 解析に失敗した動画ファイルのパス
+    """
+    options = dict(ANALYSIS_OPTIONS, **(options or {}))
+    os.makedirs(results_dir, exist_ok=True)
+    workers = max(1, min(workers, len(list_paths)))
+    pool = detector_pool.DetectorPool(workers, factory=factory)
+    cache = result_cache.ResultCache(cache_dir) if cache_dir is not None else None
+    # 複数のスレッドからの出力が混ざらないようにする
+    log_lock = threading.Lock()
+
+    def _analyze(video_path):
+        start = time.monotonic()
+        try:
+            cached = analyze_one(video_path, pool, options, results_dir, segments, cache)
+        except Exception as e:
+            with log_lock:
+                traceback.print_exc()
+                log("FAILED %s: %s" % (video_path, e))
+            # 画面から投入したジョブの状態は書き換えない
+            if isinstance(e, job_manager.JobConflictError) is False \
+                    and os.path.exists(results_dir + result_name(video_path)):
+                media_index.update_entry(
+                    results_dir, result_name(video_path),
+                    status=job_manager.FAILED, video=os.path.basename(video_path))
+            return False
+        with log_lock:
+            log("OK     %s (%s, %.1f秒)" % (
+                video_path, "キャッシュ" if cached else "解析", time.monotonic() - start))
+        return True
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list_ok = list(executor.map(_analyze, list_paths))
+    return [path for path, ok in zip(list_paths, list_ok) if ok is False]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="動画ファイルの一括解析")
+    parser.add_argument("inputs", nargs="+", help="動画ファイルのパス or ワイルドカード")
+    parser.add_argument("--workers", type=int, default=1, help="同時に解析する動画の数")
+    parser.add_argument("--segments", type=int, default=1, help="1つの動画を分割して並行して解析するプロセス数")
+    parser.add_argument("--detect-interval", type=int, default=1, help="推論するフレームの間隔")
+    parser.add_argument("--adaptive", action="store_true", help="手の動きに応じて推論の間隔を決める")
+    parser.add_argument(
+        "--video-preset", choices=list(VIDEO_ENCODE_PRESETS) + ["none"], default="preview",
+        help="出力動画のエンコード設定(noneの場合は動画を作成しない)")
+    parser.add_argument("--results-dir", default=RESULTS_DIR, help="解析結果の保存先")
+    parser.add_argument("--cache-dir", default=None, help="解析結果のキャッシュの保存先(省略時は解析結果の保存先の.cache)")
+    parser.add_argument("--no-cache", action="store_true", help="解析結果のキャッシュを使わない")
+    args = parser.parse_args(argv)
+
+    try:
+        list_paths = expand_inputs(args.inputs)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if len(list_paths) == 0:
+        print("解析する動画ファイルがありません。", file=sys.stderr)
+        return 2
+
+    options = {
+        "detect_interval": args.detect_interval,
+        "adaptive": args.adaptive,
+        "video": None if args.video_preset == "none" else args.video_preset,
+    }
+    results_dir = os.path.join(args.results_dir, "")
+    cache_dir = os.path.join(args.cache_dir or results_dir + ".cache", "")
+    list_failed = run(
+        list_paths, args.workers, options, results_dir, args.segments,
+        None if args.no_cache else cache_dir)
+    print("%d件中%d件の解析に成功しました。" % (len(list_paths), len(list_paths) - len(list_failed)))
+    return 1 if list_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
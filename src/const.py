@@ -1,4 +1,65 @@
 # 動画ファイルのアップロード先
 UPLOAD_DIR = "./videos/"
+# アップロードできる動画ファイルのサイズの上限[byte](config.tomlのmaxUploadSizeと合わせる)
+UPLOAD_MAX_BYTES = 1024 * 1024 ** 2
+# アップロードされた動画ファイルを保存するときに1回に書き込むサイズ[byte]
+UPLOAD_CHUNK_BYTES = 8 * 1024 ** 2
 # 解析結果
 RESULTS_DIR = "./results/"
+# 解析パイプラインのステージ間キューの最大長
+PIPELINE_QUEUE_SIZE = 8
+# 手のひら検知の推論モード
+# "video": フレーム間で手をトラッキングし、見失ったときだけ手のひら検出を行う(高速)
+# "image": フレームごとに手のひら検出を行う
+DETECTOR_RUNNING_MODE = "video"
+# 推論する画像の長辺の最大値[pixel](これより大きい動画は縮小してから推論する。Noneの場合は縮小しない)
+INFERENCE_MAX_SIDE = 1280
+# 推論するフレームを間引く場合の間隔の初期値(自動の場合は間隔の上限)
+DETECT_INTERVAL = 4
+# 推論の間隔を自動で決める場合に、推論の間で許容する関節点の移動量(画像の幅・高さに対する割合)
+DETECT_MOTION_THRESHOLD = 0.02
+# 出力動画のエンコード設定
+# "preview": プレビュー用(高速), "archive": 保存用(高画質)
+VIDEO_ENCODE_PRESETS = {
+    "preview": {"codec": "h264", "preset": "ultrafast", "crf": 28},
+    "archive": {"codec": "h264", "preset": "medium", "crf": 18},
+}
+# 出力動画のエンコードのスレッド数(0の場合は自動)
+VIDEO_ENCODE_THREADS = 0
+# 解析の設定の初期値
+# detect_interval: 推論するフレームの間隔(1の場合は全フレーム)
+# adaptive: 手の動きに応じて推論の間隔を自動で決めるかどうか(detect_intervalは間隔の上限)
+# video: 出力動画のエンコード設定(VIDEO_ENCODE_PRESETSのキー。Noneの場合は動画を作成しない)
+ANALYSIS_OPTIONS = {
+    "detect_interval": 1,
+    "adaptive": False,
+    "video": "preview",
+}
+# 解析の進捗を更新する頻度の上限[Hz](解析状況の画面の更新もこの頻度以下にする)
+PROGRESS_UPDATE_HZ = 10
+# 解析中のプレビュー画像を作るフレームの間隔(0の場合は作らない)
+PREVIEW_INTERVAL = 300
+# 解析中のプレビュー画像の長辺[pixel]
+PREVIEW_MAX_SIDE = 320
+# 解析の処理速度・ステージごとの処理時間を求める直近のフレーム数
+METRICS_WINDOW = 300
+# 同時に解析できる動画の数(手のひら検知モデルのインスタンス数)
+NUM_DETECTORS = 2
+# 解析結果を途中保存する区間のフレーム数
+CHUNK_FRAMES = 300
+# 解析結果のキャッシュ
+CACHE_DIR = RESULTS_DIR + ".cache/"
+# 解析結果のキャッシュの容量の上限[byte]
+CACHE_MAX_BYTES = 10 * 1024 ** 3
+# 点の数がこれを超えたら、グラフを高速描画モード(ヒストグラム・間引き)で描画する
+FAST_PLOT_THRESHOLD = 20000
+# 高速描画モードでの軌跡の点の数
+FAST_PLOT_MAX_POINTS = 2000
+# 高速描画モードでの密度分布の横方向のビン数
+FAST_PLOT_DENSITY_BINS = 200
+# 統計量・グラフのキャッシュに残す件数(関数ごと。古いものから破棄する)
+PLOT_CACHE_MAX_ENTRIES = 64
+# 解析結果のダウンロード用サーバーのポート番号
+DOWNLOAD_PORT = 8502
+# ブラウザからアクセスするときのダウンロード用サーバーのポート番号
+DOWNLOAD_PUBLIC_PORT = 8081
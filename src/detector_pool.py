@@ -0,0 +1,152 @@
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+import hands_detector
+
+
+class DetectorPool():
+    """手のひら検知モデルのプール
+
+    複数の HandsDetector を保持し、空いているモデルを利用者に貸し出す。
+    空きがない場合は到着順の待ち行列に並べ、先頭から順に割り当てる。
+    """
+    def __init__(self, num_workers, factory=hands_detector.HandsDetector):
+        """コンストラクタ
+
+        Args:
+            num_workers (int): モデルのインスタンス数
+            factory (function): モデルを生成する関数
+        """
+        self.num_workers = num_workers
+        self._free = [factory() for _ in range(num_workers)]
+        # 解析結果に影響する設定(全モデル共通)
+        self.options = self._free[0].options
+        # 使用中のモデル => 使用開始時刻
+        self._busy = {}
+        # 待ち行列(整理券)
+        self._waiting = collections.deque()
+        self._tickets = itertools.count()
+        # 直近の使用時間(待ち時間の推定用)
+        self._durations = collections.deque(maxlen=20)
+        self._cond = threading.Condition()
+
+    def request(self):
+        """整理券の発行
+
+        Args:
+            なし
+
+        Returns:
+            int: 整理券
+        """
+        with self._cond:
+            ticket = next(self._tickets)
+            self._waiting.append(ticket)
+            return ticket
+
+    def acquire(self, ticket, timeout=None):
+        """モデルの獲得
+
+        整理券の順番が来て、かつ空いているモデルがある場合に獲得できる
+
+        Args:
+            ticket (int): 整理券
+            timeout (float or None): 待ち時間の上限[秒]
+
+        Returns:
+            hands_detector.HandsDetector or None:
+                獲得したモデル(タイムアウトした場合はNone)
+        """
+        with self._cond:
+            ok = self._cond.wait_for(lambda: self._is_turn(ticket), timeout=timeout)
+            if ok is False:
+                return None
+            self._waiting.remove(ticket)
+            detector = self._free.pop()
+            self._busy[detector] = time.monotonic()
+            # 後続の整理券の順番が進む
+            self._cond.notify_all()
+            return detector
+
+    def release(self, detector):
+        """モデルの返却
+
+        Args:
+            detector (hands_detector.HandsDetector): 獲得したモデル
+
+        Returns:
+            なし
+        """
+        with self._cond:
+            started = self._busy.pop(detector)
+            self._durations.append(time.monotonic() - started)
+            self._free.append(detector)
+            self._cond.notify_all()
+
+    def cancel(self, ticket):
+        """整理券の取り消し
+
+        獲得前に待つのをやめた場合に呼ぶ。獲得済みの場合は何もしない。
+
+        Args:
+            ticket (int): 整理券
+
+        Returns:
+            なし
+        """
+        with self._cond:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+
+    def position(self, ticket):
+        """待ち行列での順番
+
+        Args:
+            ticket (int): 整理券
+
+        Returns:
+            int: 自分より前に並んでいる人数
+        """
+        with self._cond:
+            return self._waiting.index(ticket)
+
+    def estimate_wait(self, ticket):
+        """待ち時間の推定
+
+        直近の使用時間の平均から、各モデルが空く時刻を見積もって求める
+
+        Args:
+            ticket (int): 整理券
+
+        Returns:
+            float or None: 推定待ち時間[秒](まだ実績がない場合はNone)
+        """
+        with self._cond:
+            if len(self._durations) == 0:
+                return None
+            average = sum(self._durations) / len(self._durations)
+            now = time.monotonic()
+            # 各モデルが空くまでの時間
+            release_times = [0.0] * len(self._free) + [
+                max(average - (now - started), 0.0) for started in self._busy.values()
+            ]
+            heapq.heapify(release_times)
+            # 前に並んでいる人に順番に割り当てる
+            for _ in range(self._waiting.index(ticket)):
+                heapq.heappush(release_times, heapq.heappop(release_times) + average)
+            return release_times[0]
+
+    def _is_turn(self, ticket):
+        """順番が来ているかどうか
+
+        Args:
+            ticket (int): 整理券
+
+        Returns:
+            bool: 獲得可能かどうか
+        """
+        return self._waiting.index(ticket) < len(self._free)
@@ -0,0 +1,168 @@
+import os
+import json
+import threading
+import zipfile
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+import job_manager
+import landmark_store
+from const import RESULTS_DIR
+
+
+# ダウンロードのURLのパス
+DOWNLOAD_PATH = "/download/"
+# ダウンロードできる形式(解析結果フォルダのzip, 解析結果のJSON)
+DOWNLOAD_EXTENSIONS = (".zip", ".json")
+# 実行中の解析の処理速度のURLのパス(Prometheusのテキスト形式。.jsonを付けるとJSON)
+METRICS_PATH = "/metrics"
+# 1回に読み書きするサイズ[byte]
+COPY_SIZE = 1024 * 1024
+# 圧縮しない(圧縮済みの)ファイルの拡張子
+STORED_EXTENSIONS = (".mp4", ".npy")
+
+
+class DownloadServer():
+    """解析結果のダウンロード用のHTTPサーバー
+
+    解析結果フォルダをzipにしながら、少しずつレスポンスとして送信する。
+    zipファイルやその内容をメモリに展開しないため、
+    解析結果の大きさによらずメモリ使用量は一定になる。
+    解析結果のJSONのみが必要な場合は、配列形式の解析結果から少しずつ変換して送信する。
+
+    ダッシュボード向けに、実行中の解析の処理速度も返す(METRICS_PATH)。
+    """
+    def __init__(self, port, results_dir=RESULTS_DIR):
+        """コンストラクタ
+
+        サーバーは別スレッドで起動する
+
+        Args:
+            port (int): 待ち受けるポート番号
+            results_dir (str): 解析結果の保存先
+        """
+        handler = type("Handler", (_DownloadHandler,), {"results_dir": results_dir})
+        self.server = ThreadingHTTPServer(("", port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def shutdown(self):
+        """サーバーの停止
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def download_path(name, extension=".zip"):
+    """解析結果をダウンロードするURLのパス
+
+    Args:
+        name (str): 結果のフォルダ名
+        extension (str): ダウンロードする形式(DOWNLOAD_EXTENSIONSのいずれか)
+
+    Returns:
+        str: URLのパス
+    """
+    return DOWNLOAD_PATH + urllib.parse.quote(name) + extension
+
+
+class _DownloadHandler(BaseHTTPRequestHandler):
+    """ダウンロードのリクエストの処理
+    """
+    results_dir = RESULTS_DIR
+
+    def do_GET(self):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        if path in (METRICS_PATH, METRICS_PATH + ".json"):
+            self._send_metrics(path.endswith(".json"))
+            return
+        name, extension = os.path.splitext(path[len(DOWNLOAD_PATH):])
+        if path.startswith(DOWNLOAD_PATH) is False or extension not in DOWNLOAD_EXTENSIONS \
+                or name not in job_manager.list_finished_results(self.results_dir):
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/zip" if extension == ".zip" else "application/json")
+        self.send_header(
+            "Content-Disposition",
+            "attachment; filename*=UTF-8''" + urllib.parse.quote(name + extension))
+        self.end_headers()
+        try:
+            if extension == ".zip":
+                _write_zip(self.wfile, self.results_dir + name)
+            else:
+                _write_json(self.wfile, self.results_dir + name)
+        except (BrokenPipeError, ConnectionResetError):
+            # ダウンロードが中断された
+            pass
+
+    def _send_metrics(self, as_json):
+        """実行中の解析の処理速度を返す
+
+        Args:
+            as_json (bool): JSONで返すかどうか(Falseの場合はPrometheusのテキスト形式)
+        """
+        dict_snapshots = {}
+        for job in job_manager.load_jobs(self.results_dir):
+            if job["status"] != job_manager.RUNNING:
+                continue
+            snapshot = job_manager.load_metrics(self.results_dir + job["name"])
+            if snapshot is not None:
+                dict_snapshots[job["name"]] = snapshot
+        if as_json:
+            body = json.dumps(dict_snapshots).encode()
+            content_type = "application/json"
+        else:
+            body = metrics.to_prometheus(dict_snapshots).encode()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # アクセスログは出力しない
+        pass
+
+
+def _write_json(fp, directory):
+    """解析結果をJSON形式で書き出す
+
+    配列形式の解析結果があればそこから変換し、ない場合(以前のバージョンの結果)は result.json をそのまま送る
+
+    Args:
+        fp (file): 書き込み先(シークできなくてもよい)
+        directory (str): 解析結果フォルダ
+    """
+    if landmark_store.has_store(directory):
+        landmark_store.export_json(directory, fp)
+        return
+    with open(directory + "/result.json", "rb") as fin:
+        for block in iter(lambda: fin.read(COPY_SIZE), b""):
+            fp.write(block)
+
+
+def _write_zip(fp, directory):
+    """フォルダをzip形式で書き出す
+
+    Args:
+        fp (file): 書き込み先(シークできなくてもよい)
+        directory (str): zipにするフォルダ
+    """
+    with zipfile.ZipFile(fp, "w") as zf:
+        for root, _, files in os.walk(directory):
+            for name in sorted(files):
+                filename = os.path.join(root, name)
+                arcname = os.path.relpath(filename, directory)
+                zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+                if name.endswith(STORED_EXTENSIONS):
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                else:
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                with open(filename, "rb") as fin, zf.open(zinfo, "w", force_zip64=True) as fout:
+                    for block in iter(lambda: fin.read(COPY_SIZE), b""):
+                        fout.write(block)
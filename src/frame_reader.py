@@ -0,0 +1,60 @@
+import av
+
+
+class FrameReader():
+    """動画の読み込みクラス
+
+    PyAVでデコードし、RGBへの変換を1回で行う。
+    (OpenCVで読み込むと、BGRの画像を確保してからRGBの画像をもう1枚作ることになる)
+    """
+    def __init__(self, filename):
+        """コンストラクタ
+
+        Args:
+            filename (str): 動画ファイル名
+        """
+        self.container = av.open(filename)
+        self.stream = self.container.streams.video[0]
+        # デコードを複数スレッドで行う
+        self.stream.thread_type = "AUTO"
+        self.fps = float(self.stream.average_rate or self.stream.guessed_rate or 30)
+        self.width = self.stream.codec_context.width
+        self.height = self.stream.codec_context.height
+
+    def frames(self, start_frame=0, nframe=None):
+        """フレームの読み込み
+
+        Args:
+            start_frame (int): 読み込む最初のフレーム番号
+            nframe (int or None): 動画のフレーム数(これ以降は読み込まない)
+
+        Yields:
+            tuple(int, ndarray((height, width, 3), dtype=np.uint8)): フレーム番号, RGB画像
+        """
+        time_base = self.stream.time_base
+        start_pts = self.stream.start_time or 0
+        # 指定したフレームより前のフレームを読み飛ばすときの閾値(フレームの中間)
+        skip_pts = None
+        if start_frame > 0:
+            target_pts = start_pts + int((start_frame / self.fps) / time_base)
+            skip_pts = target_pts - (0.5 / self.fps) / time_base
+            # 指定したフレームの前のキーフレームに移動する
+            self.container.seek(target_pts, stream=self.stream, backward=True)
+
+        iframe = start_frame
+        for frame in self.container.decode(self.stream):
+            if nframe is not None and iframe >= nframe:
+                break
+            if skip_pts is not None and frame.pts is not None and frame.pts < skip_pts:
+                continue
+            skip_pts = None
+            # 変換結果はフレームごとに別の配列(書き換え可能)
+            yield iframe, frame.to_ndarray(format="rgb24")
+            iframe += 1
+
+    def close(self):
+        """読み込み終了
+        """
+        if self.container is not None:
+            self.container.close()
+            self.container = None
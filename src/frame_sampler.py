@@ -0,0 +1,128 @@
+import numpy as np
+
+from const import DETECT_MOTION_THRESHOLD
+
+
+class FrameSampler():
+    """推論するフレームの選択
+
+    一定間隔、または手の動きの速さに応じた間隔でキーフレームを選ぶ。
+    キーフレーム以外のフレームは推論せず、前後のキーフレームの結果から補間する。
+
+    自動の場合は、直前の2つのキーフレーム間の関節点の移動速度から、
+    次のキーフレームまでの移動量がmotion_threshold以下になるように間隔を決める
+    (間隔の上限はdetect_interval)。
+    """
+    def __init__(self, detect_interval=1, adaptive=False, motion_threshold=DETECT_MOTION_THRESHOLD):
+        """コンストラクタ
+
+        Args:
+            detect_interval (int): キーフレームの間隔(自動の場合は間隔の上限)
+            adaptive (bool): 手の動きに応じて間隔を自動で決めるかどうか
+            motion_threshold (float): キーフレーム間で許容する関節点の移動量(正規化座標)
+        """
+        self.max_interval = max(1, int(detect_interval))
+        self.adaptive = adaptive
+        self.motion_threshold = motion_threshold
+        self.interval = 1 if adaptive else self.max_interval
+        # 直前のキーフレーム
+        self._last_iframe = None
+        self._last_hands = None
+
+    def is_keyframe(self, iframe):
+        """推論するフレームかどうか
+
+        Args:
+            iframe (int): フレーム番号
+
+        Returns:
+            bool: 推論するフレームかどうか
+        """
+        return self._last_iframe is None or iframe - self._last_iframe >= self.interval
+
+    def update(self, iframe, hands):
+        """キーフレームの推論結果を記録し、次のキーフレームまでの間隔を決める
+
+        Args:
+            iframe (int): フレーム番号
+            hands (tuple(ndarray, ndarray, ndarray)):
+                HandsDetector.to_arraysで変換した解析結果
+
+        Returns:
+            なし
+        """
+        if self.adaptive and self._last_iframe is not None:
+            self.interval = self._next_interval(iframe, hands)
+        self._last_iframe = iframe
+        self._last_hands = hands
+
+    def _next_interval(self, iframe, hands):
+        """手の動きの速さから次のキーフレームまでの間隔を決める
+
+        Args:
+            iframe (int): フレーム番号
+            hands (tuple(ndarray, ndarray, ndarray)): 解析結果
+
+        Returns:
+            int: 次のキーフレームまでの間隔
+        """
+        pairs = match_hands(self._last_hands, hands)
+        if len(pairs) != len(hands[0]) or len(pairs) != len(self._last_hands[0]):
+            # 手が増えた・減った場合は、すぐに推論し直す
+            return 1
+        if len(pairs) == 0:
+            return self.max_interval
+        landmarks_a, landmarks_b = self._last_hands[0], hands[0]
+        displacement = max(
+            np.abs(landmarks_b[ib, :, :2] - landmarks_a[ia, :, :2]).max()
+            for ia, ib in pairs)
+        speed = displacement / (iframe - self._last_iframe)
+        if speed <= 0:
+            return self.max_interval
+        return int(np.clip(self.motion_threshold // speed, 1, self.max_interval))
+
+
+def match_hands(hands_a, hands_b):
+    """2つのフレームの手を左右で対応づける
+
+    左右が一意に決まる手のみ対応づける
+
+    Args:
+        hands_a (tuple(ndarray, ndarray, ndarray)): 解析結果
+        hands_b (tuple(ndarray, ndarray, ndarray)): 解析結果
+
+    Returns:
+        list(tuple(int, int)): 対応する手のインデックスの組
+    """
+    _, handedness_a, _ = hands_a
+    _, handedness_b, _ = hands_b
+    pairs = []
+    for label in np.unique(handedness_a):
+        ia = np.flatnonzero(handedness_a == label)
+        ib = np.flatnonzero(handedness_b == label)
+        if len(ia) == 1 and len(ib) == 1:
+            pairs.append((ia[0], ib[0]))
+    return pairs
+
+
+def interpolate(hands_a, hands_b, t):
+    """2つのキーフレームの解析結果の線形補間
+
+    両方のキーフレームで検出された手のみ補間する
+
+    Args:
+        hands_a (tuple(ndarray, ndarray, ndarray)): 前のキーフレームの解析結果
+        hands_b (tuple(ndarray, ndarray, ndarray)): 後のキーフレームの解析結果
+        t (float): 補間の位置(0で前、1で後のキーフレーム)
+
+    Returns:
+        tuple(ndarray, ndarray, ndarray): 補間した解析結果
+    """
+    pairs = match_hands(hands_a, hands_b)
+    ia = [pair[0] for pair in pairs]
+    ib = [pair[1] for pair in pairs]
+    landmarks_a, handedness_a, scores_a = hands_a
+    landmarks_b, _, scores_b = hands_b
+    landmarks = (1 - t) * landmarks_a[ia] + t * landmarks_b[ib]
+    scores = (1 - t) * scores_a[ia] + t * scores_b[ib]
+    return landmarks.astype(np.float32), handedness_a[ia], scores.astype(np.float32)
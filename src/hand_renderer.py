@@ -0,0 +1,101 @@
+import numpy as np
+import cv2
+from mediapipe import solutions
+
+import landmark_store
+
+
+MARGIN = 10  # pixels
+FONT_SIZE = 1
+FONT_THICKNESS = 1
+HANDEDNESS_TEXT_COLOR = (88, 205, 54)  # vibrant green
+# 関節点の縁取りの色
+BORDER_COLOR = solutions.drawing_utils.WHITE_COLOR
+
+
+def _connection_table():
+    """関節点の接続線の描画スタイルの表
+
+    mediapipeのデフォルトのスタイルを(色, 太さ)ごとにまとめる
+
+    Returns:
+        list(tuple(tuple, int, ndarray)): 色, 太さ, ndarray((線の数, 2), dtype=int) 両端の関節点のインデックス
+    """
+    styles = {}
+    for connection, spec in solutions.drawing_styles.get_default_hand_connections_style().items():
+        styles.setdefault((spec.color, spec.thickness), []).append(connection)
+    return [
+        (color, thickness, np.array(sorted(connections), dtype=int))
+        for (color, thickness), connections in styles.items()
+    ]
+
+
+def _landmark_table():
+    """関節点の描画スタイルの表
+
+    Returns:
+        list(tuple(int, tuple, int, int, int)): 関節点のインデックス, 色, 半径, 縁取りの半径, 太さ
+    """
+    table = []
+    for idx, spec in sorted(solutions.drawing_styles.get_default_hand_landmarks_style().items()):
+        border_radius = max(spec.circle_radius + 1, int(spec.circle_radius * 1.2))
+        table.append((idx, spec.color, spec.circle_radius, border_radius, spec.thickness))
+    return table
+
+
+# 描画スタイルは起動時に1回だけ作る
+CONNECTION_TABLE = _connection_table()
+LANDMARK_TABLE = _landmark_table()
+
+
+def draw_hands(image_rgb, hands, inplace=False):
+    """関節点・接続線・左右の描画
+
+    mediapipeのdraw_landmarksと同じ見た目で描画する。
+    座標の変換は全ての手をまとめて行い、接続線は同じスタイルの線をまとめて描く。
+
+    Args:
+        image_rgb (ndarray((height, width, 3), dtype=np.uint8)):
+            画像(RGB)
+        hands (tuple(ndarray, ndarray, ndarray)):
+            HandsDetector.to_arraysで変換した解析結果
+        inplace (bool):
+            Trueの場合は画像をコピーせずに直接描画する
+
+    Returns:
+        ndarray((height, width, 3), dtype=np.uint8): 描画した画像(RGB)
+    """
+    landmarks, handedness, _ = hands
+    image = image_rgb if inplace else image_rgb.copy()
+    if len(landmarks) == 0:
+        return image
+
+    height, width = image.shape[:2]
+    xy = landmarks[:, :, :2]
+    # 画像の外にある関節点は描画しない
+    visible = np.all((xy >= 0) & (xy <= 1), axis=2)
+    pixels = np.floor(xy * (width, height)).astype(np.int32)
+    np.minimum(pixels, (width - 1, height - 1), out=pixels)
+
+    # 接続線(両端の関節点が見えている線のみ)
+    for color, thickness, connections in CONNECTION_TABLE:
+        lines = pixels[:, connections]
+        mask = visible[:, connections[:, 0]] & visible[:, connections[:, 1]]
+        if mask.any():
+            cv2.polylines(image, list(lines[mask]), False, color, thickness)
+
+    # 関節点(接続線の上に描く)
+    for ihand in range(len(landmarks)):
+        for idx, color, radius, border_radius, thickness in LANDMARK_TABLE:
+            if visible[ihand, idx]:
+                center = (int(pixels[ihand, idx, 0]), int(pixels[ihand, idx, 1]))
+                cv2.circle(image, center, border_radius, BORDER_COLOR, thickness)
+                cv2.circle(image, center, radius, color, thickness)
+
+        # 左右(手を囲む矩形の左上に描く)
+        text_x = int(landmarks[ihand, :, 0].min() * width)
+        text_y = int(landmarks[ihand, :, 1].min() * height) - MARGIN
+        cv2.putText(image, landmark_store.HANDEDNESS_LABELS[handedness[ihand]],
+                    (text_x, text_y), cv2.FONT_HERSHEY_DUPLEX,
+                    FONT_SIZE, HANDEDNESS_TEXT_COLOR, FONT_THICKNESS, cv2.LINE_AA)
+    return image
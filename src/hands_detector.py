@@ -1,153 +1,188 @@
 import mediapipe as mp
 from mediapipe.tasks import python
 from mediapipe.tasks.python import vision
-from mediapipe import solutions
-from mediapipe.framework.formats import landmark_pb2
 import numpy as np
 import cv2
 
+import result_cache
+import landmark_store
+import hand_renderer
+from const import DETECTOR_RUNNING_MODE, INFERENCE_MAX_SIDE
 
-MARGIN = 10  # pixels
-FONT_SIZE = 1
-FONT_THICKNESS = 1
-HANDEDNESS_TEXT_COLOR = (88, 205, 54)  # vibrant green
+
+MODEL_PATH = 'hand_landmarker.task'
+# 推論モード
+RUNNING_MODES = {
+    "image": vision.RunningMode.IMAGE,
+    "video": vision.RunningMode.VIDEO,
+}
 
 
 class HandsDetector():
     """手のひら検知
+
+    推論モードが"video"の場合は、前のフレームで検出した手をトラッキングし、
+    トラッキングに失敗したときだけ手のひら検出を実行する。
+    この場合、フレームは動画の順に、タイムスタンプ付きで推論する必要がある。
+
+    画像の長辺がmax_sideより大きい場合は、縮小してから推論する。
+    推論結果は正規化座標のため、元の解像度のピクセル座標にそのまま変換できる。
     """
-    def __init__(self):
+    def __init__(self,
+                 model_path=MODEL_PATH,
+                 num_hands=2,
+                 min_hand_detection_confidence=0.5,
+                 min_hand_presence_confidence=0.5,
+                 min_tracking_confidence=0.5,
+                 running_mode=DETECTOR_RUNNING_MODE,
+                 max_side=INFERENCE_MAX_SIDE):
         """コンストラクタ
+
+        Args:
+            model_path (str): モデルファイルのパス
+            num_hands (int): 検出する手の最大数
+            min_hand_detection_confidence (float): 手のひら検出の信頼度の閾値
+            min_hand_presence_confidence (float): 手の存在スコアの閾値
+            min_tracking_confidence (float): トラッキングの信頼度の閾値("video"の場合のみ有効)
+            running_mode (str): 推論モード("video" or "image")
+            max_side (int or None): 推論する画像の長辺の最大値[pixel](Noneの場合は縮小しない)
         """
-        base_options = python.BaseOptions(model_asset_path='hand_landmarker.task')
-        options = vision.HandLandmarkerOptions(
+        base_options = python.BaseOptions(model_asset_path=model_path)
+        self._landmarker_options = vision.HandLandmarkerOptions(
             base_options=base_options,
-            num_hands=2,
-            min_hand_detection_confidence=0.5,
-            min_hand_presence_confidence=0.5,
-            min_tracking_confidence=0.5
+            running_mode=RUNNING_MODES[running_mode],
+            num_hands=num_hands,
+            min_hand_detection_confidence=min_hand_detection_confidence,
+            min_hand_presence_confidence=min_hand_presence_confidence,
+            min_tracking_confidence=min_tracking_confidence
         )
-        self.detector = vision.HandLandmarker.create_from_options(options)
-        self.list_label = [
-            "WRIST",
-            "THUMB_CMC",
-            "THUMB_MCP",
-            "THUMB_IP",
-            "THUMB_TIP",
-            "INDEX_FINGER_MCP",
-            "INDEX_FINGER_PIP",
-            "INDEX_FINGER_DIP",
-            "INDEX_FINGER_TIP",
-            "MIDDLE_FINGER_MCP",
-            "MIDDLE_FINGER_PIP",
-            "MIDDLE_FINGER_DIP",
-            "MIDDLE_FINGER_TIP",
-            "RING_FINGER_MCP",
-            "RING_FINGER_PIP",
-            "RING_FINGER_DIP",
-            "RING_FINGER_TIP",
-            "PINKY_MCP",
-            "PINKY_PIP",
-            "PINKY_DIP",
-            "PINKY_TIP"
-        ]
-
-    def detect(self, image_rgb):
-        """検出関数
+        self.running_mode = running_mode
+        self.max_side = max_side
+        self.detector = vision.HandLandmarker.create_from_options(self._landmarker_options)
+        # 直前に推論したフレームのタイムスタンプ[ms]("video"の場合のみ使う)
+        self._last_timestamp_ms = -1
+        # 解析結果に影響する設定(解析結果のキャッシュのキーに使う)
+        self.options = {
+            "model_sha256": result_cache.file_sha256(model_path),
+            "num_hands": num_hands,
+            "min_hand_detection_confidence": min_hand_detection_confidence,
+            "min_hand_presence_confidence": min_hand_presence_confidence,
+            "min_tracking_confidence": min_tracking_confidence,
+            "running_mode": running_mode,
+            "max_side": max_side,
+        }
+        self.list_label = landmark_store.LANDMARK_LABELS
+
+    def reset(self):
+        """トラッキング状態の初期化
+
+        別の動画(または同じ動画の途中)から推論を始める前に呼ぶ。
+        "video"の場合は、前の動画のトラッキング結果を引き継がないように、
+        またタイムスタンプを0から始められるようにモデルを作り直す。
+
+        Returns:
+            なし
+        """
+        if self.running_mode == "image":
+            return
+        self.detector.close()
+        self.detector = vision.HandLandmarker.create_from_options(self._landmarker_options)
+        self._last_timestamp_ms = -1
+
+    def infer(self, image_rgb, timestamp_ms=None):
+        """推論関数
+
+        描画は行わず、推論のみを実行する(結果はto_arraysで配列に変換する)
 
         Args:
-            image_bgr (ndarray((height, width, 3), dtype=np.uint8)):
+            image_rgb (ndarray((height, width, 3), dtype=np.uint8)):
                 RGB画像
+            timestamp_ms (int or None):
+                フレームのタイムスタンプ[ms]("video"の場合のみ使う)
 
         Returns:
-            list(dict): 検出結果,
-            ndarray((height, width, 3), dtype=np.uint8): 描画画像(RGB)
+            mediapipe.tasks.python.vision.hand_landmarker.HandLandmarkerResult:
+                解析結果
         """
         image = mp.Image(
             image_format=mp.ImageFormat.SRGB,
-            data=image_rgb)
-        detection_result = self.detector.detect(image)
-        return self._to_json(image_rgb, detection_result), self._draw(image_rgb, detection_result)
+            data=self._resize(image_rgb))
+        if self.running_mode == "image":
+            return self.detector.detect(image)
 
-    def _to_json(self, image_rgb, detection_result):
-        """JSON変換関数
-        mediapipe独自のオブジェクトをJSONフォーマットに変換する
+        # タイムスタンプは単調増加でなければならないため、
+        # フレームレートの丸めなどで前のフレームと重なった場合は1msずらす
+        if timestamp_ms is None or timestamp_ms <= self._last_timestamp_ms:
+            timestamp_ms = self._last_timestamp_ms + 1
+        self._last_timestamp_ms = timestamp_ms
+        return self.detector.detect_for_video(image, timestamp_ms)
+
+    def _resize(self, image_rgb):
+        """推論用の縮小
 
         Args:
-            image (ndarray((height, width, 3), dtype=np.uint8)):
-                画像オブジェクト
-            detedetection_result (mediapipe.tasks.python.vision.hand_landmarker.HandLandmarkerResult):
-                解析結果
+            image_rgb (ndarray((height, width, 3), dtype=np.uint8)):
+                RGB画像
 
         Returns:
-            list(dict):
-                JSONフォーマット
+            ndarray((height, width, 3), dtype=np.uint8):
+                長辺がmax_side以下のRGB画像
         """
         h, w = image_rgb.shape[:2]
-        hand_landmarks_list = detection_result.hand_landmarks
-        handedness_list = detection_result.handedness
+        if self.max_side is None or max(h, w) <= self.max_side:
+            return image_rgb
+        scale = self.max_side / max(h, w)
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        return cv2.resize(image_rgb, size, interpolation=cv2.INTER_AREA)
 
-        # Loop through the detected hands
-        result_json = []
-        for idx in range(len(hand_landmarks_list)):
-            hand_landmarks = hand_landmarks_list[idx]
-            handedness = handedness_list[idx]
-            result_dict = {}
+    def to_arrays(self, detection_result):
+        """配列変換関数
+        mediapipe独自のオブジェクトを配列に変換する
 
-            result_dict["CategoryName"] = handedness[0].category_name
-            result_dict["Score"] = handedness[0].score
-            coordinates = np.array([[landmark.x, landmark.y] for landmark in hand_landmarks])
-            coordinates[:, 0] *= w
-            coordinates[:, 1] *= h
-            result_dict["Coordinates"] = {self.list_label[i]: coord for i, coord in enumerate(coordinates.tolist())}
-
-            result_json.append(result_dict)
-        return result_json
+        Args:
+            detection_result (mediapipe.tasks.python.vision.hand_landmarker.HandLandmarkerResult):
+                解析結果
 
-    def _draw(self, image_rgb, detection_result):
+        Returns:
+            tuple:
+                ndarray((手の数, 21, 3), dtype=np.float32): 正規化座標(x, y, z),
+                ndarray((手の数,), dtype=np.int8): 左右(HANDEDNESS_LABELSのインデックス),
+                ndarray((手の数,), dtype=np.float32): 左右判定のスコア
+        """
+        hand_landmarks_list = detection_result.hand_landmarks
+        handedness_list = detection_result.handedness
+        nhands = len(hand_landmarks_list)
+
+        # 中間のリストを作らずに、各配列を1回の確保で直接埋める
+        # (戻り値はパイプラインのキューや補間の待ち合わせで複数フレーム保持されるため、
+        # フレームごとに別の配列を返す。使い回すと後のフレームで上書きされてしまう)
+        landmarks = np.fromiter(
+            (value
+             for hand_landmarks in hand_landmarks_list
+             for landmark in hand_landmarks
+             for value in (landmark.x, landmark.y, landmark.z)),
+            dtype=np.float32, count=nhands * len(self.list_label) * 3,
+        ).reshape(nhands, len(self.list_label), 3)
+        handedness = np.fromiter(
+            (landmark_store.HANDEDNESS_LABELS.index(categories[0].category_name) for categories in handedness_list),
+            dtype=np.int8, count=nhands)
+        scores = np.fromiter(
+            (categories[0].score for categories in handedness_list), dtype=np.float32, count=nhands)
+        return landmarks, handedness, scores
+
+    def draw(self, image_rgb, hands, inplace=False):
         """描画関数
 
         Args:
             image_rgb (ndarray((height, width, 3), dtype=np.uint8)):
                 画像オブジェクト(RGB)
-            detedetection_result (mediapipe.tasks.python.vision.hand_landmarker.HandLandmarkerResult):
-                解析結果
+            hands (tuple(ndarray, ndarray, ndarray)):
+                to_arraysで変換した解析結果
+            inplace (bool):
+                Trueの場合は画像をコピーせずに直接描画する
 
         Returns:
             ndarray((height, width, 3), dtype=np.uint8):
                 RGB画像
         """
-        hand_landmarks_list = detection_result.hand_landmarks
-        handedness_list = detection_result.handedness
-        annotated_image = np.copy(image_rgb)
-
-        # Loop through the detected hands to visualize.
-        for idx in range(len(hand_landmarks_list)):
-            hand_landmarks = hand_landmarks_list[idx]
-            handedness = handedness_list[idx]
-
-            # Draw the hand landmarks.
-            hand_landmarks_proto = landmark_pb2.NormalizedLandmarkList()
-            hand_landmarks_proto.landmark.extend([
-              landmark_pb2.NormalizedLandmark(x=landmark.x, y=landmark.y, z=landmark.z) for landmark in hand_landmarks
-            ])
-            solutions.drawing_utils.draw_landmarks(
-              annotated_image,
-              hand_landmarks_proto,
-              solutions.hands.HAND_CONNECTIONS,
-              solutions.drawing_styles.get_default_hand_landmarks_style(),
-              solutions.drawing_styles.get_default_hand_connections_style())
-
-            # Get the top left corner of the detected hand's bounding box.
-            height, width, _ = annotated_image.shape
-            x_coordinates = [landmark.x for landmark in hand_landmarks]
-            y_coordinates = [landmark.y for landmark in hand_landmarks]
-            text_x = int(min(x_coordinates) * width)
-            text_y = int(min(y_coordinates) * height) - MARGIN
-
-            # Draw handedness (left or right hand) on the image.
-            cv2.putText(annotated_image, f"{handedness[0].category_name}",
-                        (text_x, text_y), cv2.FONT_HERSHEY_DUPLEX,
-                        FONT_SIZE, HANDEDNESS_TEXT_COLOR, FONT_THICKNESS, cv2.LINE_AA)
-
-        return annotated_image
+        return hand_renderer.draw_hands(image_rgb, hands, inplace)
@@ -0,0 +1,437 @@
+import os
+import glob
+import json
+import time
+import threading
+import traceback
+import uuid
+
+import analyzer
+import metrics
+import media_index
+import result_writer
+import result_cache
+from const import UPLOAD_DIR, RESULTS_DIR, CACHE_DIR, ANALYSIS_OPTIONS, PROGRESS_UPDATE_HZ
+
+
+# ジョブの状態
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# ジョブの状態ファイル名(解析結果フォルダ内に保存する)
+JOB_FILE = "job.json"
+# 進捗を状態ファイルに書き出す間隔[秒]
+SAVE_INTERVAL = 1.0
+
+
+class JobConflictError(Exception):
+    """同じ動画の解析ジョブが実行中であることを表す例外
+    """
+
+
+class JobManager():
+    """解析ジョブの管理クラス
+
+    解析はStreamlitのスクリプト実行とは別のスレッドで行うため、
+    ブラウザを閉じたり画面が再実行されたりしても中断されない。
+    ジョブの状態は解析結果フォルダの job.json に保存し、
+    サーバーの再起動時には未完了のジョブを再投入する。
+
+    解析の進捗は、毎フレームではなく PROGRESS_UPDATE_HZ 以下の頻度でジョブの状態に反映する。
+    画面はジョブの状態を読むだけなので、解析の処理を待たせない。
+    """
+    def __init__(self, pool, upload_dir=UPLOAD_DIR, results_dir=RESULTS_DIR, cache_dir=CACHE_DIR):
+        """コンストラクタ
+
+        Args:
+            pool (detector_pool.DetectorPool): AIモデルのプール
+            upload_dir (str): 動画ファイルのアップロード先
+            results_dir (str): 解析結果の保存先
+            cache_dir (str): 解析結果のキャッシュの保存先
+        """
+        self.pool = pool
+        self.upload_dir = upload_dir
+        self.results_dir = results_dir
+        self.cache = result_cache.ResultCache(cache_dir)
+        # ジョブID => ジョブの状態
+        self._jobs = {}
+        # ジョブID => AIモデルの整理券
+        self._tickets = {}
+        # ジョブID => 実行中のジョブの処理速度の計測
+        self._metrics = {}
+        # ジョブID => 実行中のジョブのプレビュー画像(フレーム番号, 縮小した描画画像)
+        self._previews = {}
+        self._lock = threading.Lock()
+        self._recover()
+
+    def submit(self, video, options=None, segments=1):
+        """解析ジョブの投入
+
+        Args:
+            video (str): 解析する動画ファイル名
+            options (dict or None): 解析の設定(ANALYSIS_OPTIONSと同じ形式)
+            segments (int): 動画を分割して並行して解析するプロセス数
+
+        Returns:
+            str: ジョブID
+
+        Raises:
+            JobConflictError: 同じ動画の解析ジョブが実行中の場合
+        """
+        name = video.rsplit(".", maxsplit=1)[0]
+        with self._lock:
+            for job in self._jobs.values():
+                if job["name"] == name and job["status"] in (QUEUED, RUNNING):
+                    raise JobConflictError(name)
+            job = {
+                "id": uuid.uuid4().hex,
+                "video": video,
+                "name": name,
+                "status": QUEUED,
+                "options": dict(ANALYSIS_OPTIONS, **(options or {})),
+                # 解析結果には影響しないため、キャッシュのキーには含めない
+                "segments": segments,
+                "nframe": 0,
+                "processed": 0,
+                "error": None,
+                "cache_key": None,
+                "cached": False,
+                "submitted_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+            }
+            self._jobs[job["id"]] = job
+            self._save(job)
+        self._start(job["id"])
+        return job["id"]
+
+    def get(self, job_id):
+        """ジョブの状態の取得
+
+        Args:
+            job_id (str): ジョブID
+
+        Returns:
+            dict or None: ジョブの状態(存在しない場合はNone)
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def list_jobs(self):
+        """ジョブの一覧
+
+        Args:
+            なし
+
+        Returns:
+            list(dict): ジョブの状態(投入順)
+        """
+        with self._lock:
+            jobs = [dict(job) for job in self._jobs.values()]
+        return sorted(jobs, key=lambda job: job["submitted_at"])
+
+    def get_metrics(self, job_id):
+        """実行中のジョブの処理速度の取得
+
+        Args:
+            job_id (str): ジョブID
+
+        Returns:
+            dict or None: metrics.PipelineMetrics.snapshotの結果(実行中でない場合はNone)
+        """
+        job_metrics = self._metrics.get(job_id)
+        return job_metrics.snapshot() if job_metrics is not None else None
+
+    def get_preview(self, job_id):
+        """実行中のジョブのプレビュー画像の取得
+
+        Args:
+            job_id (str): ジョブID
+
+        Returns:
+            tuple(int, ndarray) or None: フレーム番号, 縮小した描画画像(RGB)(まだない場合はNone)
+        """
+        return self._previews.get(job_id)
+
+    def position(self, job_id):
+        """待ち行列での順番
+
+        Args:
+            job_id (str): ジョブID
+
+        Returns:
+            int or None: 前に並んでいるジョブの数(待ち行列にいない場合はNone)
+        """
+        ticket = self._tickets.get(job_id)
+        if ticket is None:
+            return None
+        try:
+            return self.pool.position(ticket)
+        except ValueError:
+            # 直前にAIモデルを獲得した
+            return None
+
+    def estimate_wait(self, job_id):
+        """待ち時間の推定
+
+        Args:
+            job_id (str): ジョブID
+
+        Returns:
+            float or None: 推定待ち時間[秒](推定できない場合はNone)
+        """
+        ticket = self._tickets.get(job_id)
+        if ticket is None:
+            return None
+        try:
+            return self.pool.estimate_wait(ticket)
+        except ValueError:
+            return None
+
+    def _start(self, job_id):
+        """ジョブのスレッドを開始する
+
+        Args:
+            job_id (str): ジョブID
+        """
+        # 投入順にAIモデルを割り当てるため、整理券はここで発行する
+        self._tickets[job_id] = self.pool.request()
+        thread = threading.Thread(target=self._run, args=(job_id,), daemon=True)
+        thread.start()
+
+    def _run(self, job_id):
+        """ジョブの実行
+
+        Args:
+            job_id (str): ジョブID
+        """
+        ticket = self._tickets[job_id]
+        job = self._jobs[job_id]
+        video_path = self.upload_dir + job["video"]
+        outdir = self.results_dir + job["name"]
+        # 以前のバージョンで投入されたジョブには解析の設定がない(または一部しかない)
+        options = dict(ANALYSIS_OPTIONS, **job.get("options", {}))
+        try:
+            # 同じ動画を同じ設定で解析済みであれば、保存済みの結果を使う
+            key = self.cache.key(media_index.video_sha256(video_path), dict(self.pool.options, **options))
+            if self.cache.lookup(key, outdir):
+                # 以前の解析の処理速度は残さない
+                if os.path.exists(outdir + "/" + metrics.METRICS_FILE):
+                    os.remove(outdir + "/" + metrics.METRICS_FILE)
+                self.pool.cancel(ticket)
+                del self._tickets[job_id]
+                with self._lock:
+                    job["cache_key"] = key
+                    job["cached"] = True
+                    job["status"] = DONE
+                    job["finished_at"] = time.time()
+                    self._save(job)
+                return
+        except Exception as e:
+            self.pool.cancel(ticket)
+            del self._tickets[job_id]
+            self._fail(job, e)
+            return
+
+        detector = self.pool.acquire(ticket)
+        del self._tickets[job_id]
+        try:
+            with self._lock:
+                job["cache_key"] = key
+                job["status"] = RUNNING
+                job["started_at"] = time.time()
+                self._save(job)
+
+            last_saved = time.monotonic()
+            last_updated = 0.0
+            job_metrics = metrics.PipelineMetrics()
+            self._metrics[job_id] = job_metrics
+
+            def _update_progress(iframe, nframe):
+                nonlocal last_saved, last_updated
+                job_metrics.frame_done(iframe + 1, nframe)
+                # 進捗の反映は時間で間引く(最後のフレームは必ず反映する)
+                now = time.monotonic()
+                if now - last_updated < 1 / PROGRESS_UPDATE_HZ and iframe + 1 < nframe:
+                    return
+                last_updated = now
+                with self._lock:
+                    job["nframe"] = nframe
+                    job["processed"] = iframe + 1
+                    if now - last_saved >= SAVE_INTERVAL:
+                        self._save(job)
+                        # 他の画面・ダッシュボードからも見られるように、処理速度も保存する
+                        self._save_metrics(job, job_metrics)
+                        last_saved = now
+
+            def _update_preview(iframe, image):
+                # 画面は最新の1枚だけを表示する
+                self._previews[job_id] = (iframe, image)
+
+            analyzer.analyze_video(
+                video_path, outdir, detector, callback=_update_progress, options=options,
+                segments=job.get("segments", 1), metrics=job_metrics,
+                preview=_update_preview)
+            self._save_metrics(job, job_metrics)
+            self.cache.store(key, outdir)
+
+            with self._lock:
+                job["status"] = DONE
+                job["finished_at"] = time.time()
+                self._save(job)
+        except Exception as e:
+            self._fail(job, e)
+        finally:
+            self._metrics.pop(job_id, None)
+            self._previews.pop(job_id, None)
+            self.pool.release(detector)
+
+    def _fail(self, job, e):
+        """ジョブを失敗として記録する
+
+        Args:
+            job (dict): ジョブの状態
+            e (Exception): 発生した例外
+        """
+        traceback.print_exc()
+        with self._lock:
+            job["status"] = FAILED
+            job["error"] = str(e)
+            job["finished_at"] = time.time()
+            self._save(job)
+
+    def _recover(self):
+        """保存されているジョブの読み込み
+
+        前回の起動時に完了しなかったジョブは待ち行列に再投入する
+        """
+        for job in load_jobs(self.results_dir):
+            self._jobs[job["id"]] = job
+        for job in self.list_jobs():
+            if job["status"] in (QUEUED, RUNNING):
+                self._jobs[job["id"]]["status"] = QUEUED
+                self._start(job["id"])
+
+    def _save(self, job):
+        """ジョブの状態をファイルに保存する
+
+        解析結果の索引にも状態を反映する(状態が変わらない場合は索引を書き込まない)
+
+        Args:
+            job (dict): ジョブの状態
+        """
+        outdir = self.results_dir + job["name"]
+        if os.path.exists(outdir) is False:
+            os.mkdir(outdir)
+        result_writer.write_json_atomic(outdir + "/" + JOB_FILE, job)
+        fields = {"status": job["status"], "video": job["video"]}
+        if job["status"] == DONE:
+            # 結果の確認画面で動画を開かずに済むように、動画情報も記録する
+            info = media_index.get_video(job["video"], self.upload_dir) or {}
+            fields.update({
+                key: info.get(key) for key in ("nframe", "fps", "width", "height", "duration")
+            })
+            fields["has_video"] = os.path.exists(outdir + "/result.mp4")
+        media_index.update_entry(self.results_dir, job["name"], **fields)
+
+    def _save_metrics(self, job, job_metrics):
+        """ジョブの処理速度をファイルに保存する
+
+        Args:
+            job (dict): ジョブの状態
+            job_metrics (metrics.PipelineMetrics): 処理速度の計測
+        """
+        result_writer.write_json_atomic(
+            self.results_dir + job["name"] + "/" + metrics.METRICS_FILE, job_metrics.snapshot())
+
+
+def load_metrics(outdir):
+    """保存されている処理速度の読み込み
+
+    Args:
+        outdir (str): 結果フォルダのパス
+
+    Returns:
+        dict or None: metrics.PipelineMetrics.snapshotの結果(保存されていない場合はNone)
+    """
+    try:
+        with open(outdir + "/" + metrics.METRICS_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_jobs(results_dir=RESULTS_DIR):
+    """保存されているジョブの読み込み
+
+    Args:
+        results_dir (str): 解析結果の保存先
+
+    Returns:
+        list(dict): ジョブの状態
+    """
+    list_jobs = []
+    for filename in glob.glob(results_dir + "*/" + JOB_FILE):
+        try:
+            with open(filename) as f:
+                list_jobs.append(json.load(f))
+        except (OSError, ValueError):
+            # 書き込み途中などで読めないファイルは無視する
+            continue
+    return list_jobs
+
+
+def list_finished_results(results_dir=RESULTS_DIR):
+    """解析が完了した結果の一覧
+
+    解析結果の索引から状態を取得する。
+    索引にない結果フォルダは、このときに一度だけジョブの状態ファイルを読んで索引に追加する。
+    ジョブの状態ファイルがない結果フォルダは、以前のバージョンで解析したものとみなす
+
+    Args:
+        results_dir (str): 解析結果の保存先
+
+    Returns:
+        list(str): 結果のフォルダ名
+    """
+    if os.path.exists(results_dir) is False:
+        return []
+    index = media_index.load_index(results_dir)
+    list_results = []
+    for name in sorted(entry.name for entry in os.scandir(results_dir) if entry.is_dir()):
+        if name.startswith("."):
+            # キャッシュなど
+            continue
+        if name not in index:
+            status = _read_status(results_dir + name)
+            if status is None:
+                continue
+            index[name] = media_index.update_entry(results_dir, name, status=status)
+        if index[name]["status"] == DONE:
+            list_results.append(name)
+    return list_results
+
+
+def _read_status(outdir):
+    """結果フォルダのジョブの状態の読み込み
+
+    Args:
+        outdir (str): 結果フォルダのパス
+
+    Returns:
+        str or None: ジョブの状態(結果フォルダでない場合・読めない場合はNone)
+    """
+    filename = outdir + "/" + JOB_FILE
+    if os.path.exists(filename):
+        try:
+            with open(filename) as f:
+                return json.load(f)["status"]
+        except (OSError, ValueError):
+            return None
+    elif os.path.exists(outdir + "/result.json"):
+        return DONE
+    return None
+
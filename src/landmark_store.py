@@ -0,0 +1,300 @@
+import os
+import json
+
+import numpy as np
+
+
+# 手の関節点の名前(インデックス順)
+LANDMARK_LABELS = [
+    "WRIST",
+    "THUMB_CMC",
+    "THUMB_MCP",
+    "THUMB_IP",
+    "THUMB_TIP",
+    "INDEX_FINGER_MCP",
+    "INDEX_FINGER_PIP",
+    "INDEX_FINGER_DIP",
+    "INDEX_FINGER_TIP",
+    "MIDDLE_FINGER_MCP",
+    "MIDDLE_FINGER_PIP",
+    "MIDDLE_FINGER_DIP",
+    "MIDDLE_FINGER_TIP",
+    "RING_FINGER_MCP",
+    "RING_FINGER_PIP",
+    "RING_FINGER_DIP",
+    "RING_FINGER_TIP",
+    "PINKY_MCP",
+    "PINKY_PIP",
+    "PINKY_DIP",
+    "PINKY_TIP"
+]
+# 左右の名前(インデックス順)
+HANDEDNESS_LABELS = ["Left", "Right"]
+
+# 保存先フォルダ名(解析結果フォルダ内)
+STORE_DIR = "landmarks"
+# 保存するファイル
+COORDINATES_FILE = "coordinates.npy"
+HANDEDNESS_FILE = "handedness.npy"
+SCORES_FILE = "scores.npy"
+INTERPOLATED_FILE = "interpolated.npy"
+META_FILE = "meta.json"
+STORE_FILES = [COORDINATES_FILE, HANDEDNESS_FILE, SCORES_FILE, INTERPOLATED_FILE, META_FILE]
+
+
+class LandmarkStoreWriter():
+    """関節点の配列形式での書き込みクラス
+
+    解析結果を固定長の配列としてメモリマップで書き込む。
+    各配列の形状は以下のとおり(検出されなかった手は座標がNaN、左右が-1)。
+
+    - coordinates: (フレーム数, 手の数, 21, 3) float32 … 正規化座標 x, y, z
+      (x, y にメタ情報の幅・高さを掛けるとピクセル座標になる)
+    - handedness: (フレーム数, 手の数) int8 … HANDEDNESS_LABELSのインデックス
+    - scores: (フレーム数, 手の数) float32 … 左右判定のスコア
+    - interpolated: (フレーム数,) bool … 推論せずに前後のフレームから補間したかどうか
+    """
+    def __init__(self, outdir, nframe, num_hands, shape, resume=False):
+        """コンストラクタ
+
+        Args:
+            outdir (str): 解析結果の出力先フォルダ
+            nframe (int): フレーム数
+            num_hands (int): 1フレームあたりの手の最大数
+            shape (tuple(int, int)): (幅, 高さ)
+            resume (bool): 書き込み途中のファイルに続きを書くかどうか
+        """
+        self.store_dir = outdir + "/" + STORE_DIR
+        if resume and all(os.path.exists(self.store_dir + "/" + name) for name in STORE_FILES):
+            with open(self.store_dir + "/" + META_FILE) as f:
+                self.meta = json.load(f)
+            mode = "r+"
+        else:
+            os.makedirs(self.store_dir, exist_ok=True)
+            # 以前の結果はキャッシュとハードリンクで共有されている場合があるため、
+            # 上書きせずに削除してから作り直す
+            for name in STORE_FILES:
+                if os.path.exists(self.store_dir + "/" + name):
+                    os.remove(self.store_dir + "/" + name)
+            self.meta = {
+                "nframe": 0,
+                "num_hands": num_hands,
+                "width": shape[0],
+                "height": shape[1],
+                "landmark_labels": LANDMARK_LABELS,
+                "handedness_labels": HANDEDNESS_LABELS,
+            }
+            mode = "w+"
+        self.coordinates = self._open(COORDINATES_FILE, mode, np.float32, (nframe, num_hands, len(LANDMARK_LABELS), 3), np.nan)
+        self.handedness = self._open(HANDEDNESS_FILE, mode, np.int8, (nframe, num_hands), -1)
+        self.scores = self._open(SCORES_FILE, mode, np.float32, (nframe, num_hands), np.nan)
+        self.interpolated = self._open(INTERPOLATED_FILE, mode, np.bool_, (nframe,), False)
+        if mode == "w+":
+            self._save_meta()
+
+    def write(self, iframe, hands, interpolated=False):
+        """1フレーム分の書き込み
+
+        Args:
+            iframe (int): フレーム番号
+            hands (tuple(ndarray, ndarray, ndarray)):
+                HandsDetector.to_arraysで変換した解析結果
+            interpolated (bool): 前後のフレームから補間した結果かどうか
+
+        Returns:
+            なし
+        """
+        if iframe >= len(self.coordinates):
+            # 動画のフレーム数の情報が実際より少ない場合は書き込めない
+            return
+        landmarks, handedness, scores = hands
+        n = min(len(landmarks), self.meta["num_hands"])
+        self.coordinates[iframe, :n] = landmarks[:n]
+        self.handedness[iframe, :n] = handedness[:n]
+        self.scores[iframe, :n] = scores[:n]
+        # 中断した解析の続きから書く場合に、前回の結果の手が残らないようにする
+        self.coordinates[iframe, n:] = np.nan
+        self.handedness[iframe, n:] = -1
+        self.scores[iframe, n:] = np.nan
+        self.interpolated[iframe] = interpolated
+
+    def to_json(self, start, stop):
+        """書き込んだフレームのJSONフォーマット(result.jsonと同じ形式)への変換
+
+        Args:
+            start (int): 変換する最初のフレーム番号
+            stop (int): 変換する最後のフレーム番号+1
+
+        Returns:
+            list(dict): フレームごとの検出結果
+        """
+        stop = min(stop, len(self.coordinates))
+        size = np.array([self.meta["width"], self.meta["height"]], dtype=np.float64)
+        return _to_json(
+            start, self.coordinates[start:stop], self.handedness[start:stop],
+            self.scores[start:stop], self.interpolated[start:stop], size)
+
+    def flush(self):
+        """書き込んだ内容をディスクに反映する
+
+        Returns:
+            なし
+        """
+        self.coordinates.flush()
+        self.handedness.flush()
+        self.scores.flush()
+        self.interpolated.flush()
+
+    def close(self, nframe):
+        """書き込み終了
+
+        Args:
+            nframe (int): 書き込みが完了したフレーム数
+
+        Returns:
+            なし
+        """
+        self.flush()
+        self.meta["nframe"] = min(nframe, len(self.coordinates))
+        self._save_meta()
+
+    def _open(self, name, mode, dtype, shape, fill_value):
+        """配列ファイルをメモリマップで開く
+
+        Args:
+            name (str): ファイル名
+            mode (str): "w+"(新規作成) or "r+"(続きを書く)
+            dtype (numpy.dtype): 型
+            shape (tuple(int)): 形状
+            fill_value (object): 新規作成時の初期値
+
+        Returns:
+            numpy.memmap: 配列
+        """
+        array = np.lib.format.open_memmap(
+            self.store_dir + "/" + name, mode=mode, dtype=dtype, shape=shape if mode == "w+" else None)
+        if mode == "w+":
+            array[:] = fill_value
+        return array
+
+    def _save_meta(self):
+        """メタ情報の保存
+        """
+        tmp = self.store_dir + "/" + META_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, self.store_dir + "/" + META_FILE)
+
+
+class LandmarkStore():
+    """関節点の配列形式での読み込みクラス
+
+    配列はメモリマップで開くため、参照した部分だけがディスクから読み込まれる
+    """
+    def __init__(self, outdir):
+        """コンストラクタ
+
+        Args:
+            outdir (str): 解析結果フォルダ
+        """
+        store_dir = outdir + "/" + STORE_DIR
+        with open(store_dir + "/" + META_FILE) as f:
+            self.meta = json.load(f)
+        nframe = self.meta["nframe"]
+        self.coordinates = np.load(store_dir + "/" + COORDINATES_FILE, mmap_mode="r")[:nframe]
+        self.handedness = np.load(store_dir + "/" + HANDEDNESS_FILE, mmap_mode="r")[:nframe]
+        self.scores = np.load(store_dir + "/" + SCORES_FILE, mmap_mode="r")[:nframe]
+        self.interpolated = np.load(store_dir + "/" + INTERPOLATED_FILE, mmap_mode="r")[:nframe]
+        # 正規化座標からピクセル座標への倍率
+        self.size = np.array([self.meta["width"], self.meta["height"]], dtype=np.float64)
+
+    def __len__(self):
+        return self.meta["nframe"]
+
+    def to_json(self, start=0, stop=None):
+        """JSONフォーマット(result.jsonと同じ形式)への変換
+
+        Args:
+            start (int): 変換する最初のフレーム番号
+            stop (int or None): 変換する最後のフレーム番号+1(Noneの場合は最後まで)
+
+        Returns:
+            list(dict): フレームごとの検出結果
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        return _to_json(
+            start, self.coordinates[start:stop], self.handedness[start:stop],
+            self.scores[start:stop], self.interpolated[start:stop], self.size)
+
+
+def _to_json(start, coordinates, handedness, scores, interpolated, size):
+    """配列のJSONフォーマットへの変換
+
+    ピクセル座標への変換とPythonの値への変換は、フレームをまとめて1回で行う
+
+    Args:
+        start (int): 最初のフレーム番号
+        coordinates (ndarray((フレーム数, 手の数, 21, 3), dtype=np.float32)): 正規化座標
+        handedness (ndarray((フレーム数, 手の数), dtype=np.int8)): 左右
+        scores (ndarray((フレーム数, 手の数), dtype=np.float32)): 左右判定のスコア
+        interpolated (ndarray((フレーム数,), dtype=bool)): 補間したかどうか
+        size (ndarray((2,), dtype=np.float64)): 幅, 高さ
+
+    Returns:
+        list(dict): フレームごとの検出結果
+    """
+    list_coordinates = (coordinates[..., :2].astype(np.float64) * size).tolist()
+    list_handedness = np.asarray(handedness).tolist()
+    list_scores = np.asarray(scores, dtype=np.float64).tolist()
+    list_interpolated = np.asarray(interpolated).tolist()
+    list_results = []
+    for i in range(len(list_handedness)):
+        results = [
+            {
+                "CategoryName": HANDEDNESS_LABELS[label],
+                "Score": list_scores[i][ihand],
+                "Coordinates": dict(zip(LANDMARK_LABELS, list_coordinates[i][ihand])),
+            }
+            for ihand, label in enumerate(list_handedness[i]) if label >= 0
+        ]
+        list_results.append({
+            "FrameNumber": start + i,
+            "Interpolated": list_interpolated[i],
+            "Results": results
+        })
+    return list_results
+
+
+def has_store(outdir):
+    """配列形式の解析結果があるかどうか
+
+    Args:
+        outdir (str): 解析結果フォルダ
+
+    Returns:
+        bool: 配列形式の解析結果があるかどうか
+    """
+    return all(os.path.exists(outdir + "/" + STORE_DIR + "/" + name) for name in STORE_FILES)
+
+
+def export_json(outdir, fp, batch_size=1000):
+    """配列形式の解析結果をJSON形式(result.jsonと同じ形式)で書き出す
+
+    全フレームをメモリに展開しないよう、batch_sizeフレームずつ書き出す
+
+    Args:
+        outdir (str): 解析結果フォルダ
+        fp (file): 書き込み先(バイナリ。シークできなくてもよい)
+        batch_size (int): 一度に変換するフレーム数
+
+    Returns:
+        なし
+    """
+    store = LandmarkStore(outdir)
+    fp.write(b"[")
+    for start in range(0, len(store), batch_size):
+        body = json.dumps(store.to_json(start, start + batch_size))[1:-1]
+        if start > 0:
+            fp.write(b", ")
+        fp.write(body.encode())
+    fp.write(b"]")
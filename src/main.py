@@ -1,5 +1,7 @@
 import streamlit as st
 
+import shared_resources
+
 
 def main():
     # ページの設定
@@ -9,6 +11,12 @@ def main():
         layout="wide",  # ページレイアウト
     )
 
+    # ダウンロード用サーバー(全ユーザーで共有)
+    # 処理速度の取得(/metrics)にも使うため、最初のページを開いた時点で起動する
+    shared_resources.load_download_server()
+    # 解析ジョブの管理クラス(全ユーザーで共有。前回の起動時に完了しなかったジョブを再開する)
+    shared_resources.load_job_manager()
+
     # 結果の確認とダウンロード
     st.header("streamlitのサンプルプログラム")
     st.markdown(
@@ -0,0 +1,326 @@
+import os
+import json
+import fcntl
+import threading
+import contextlib
+
+import cv2
+
+import analyzer
+import result_cache
+import result_writer
+from const import UPLOAD_DIR, RESULTS_DIR
+
+
+# 索引ファイル名(動画のアップロード先・解析結果の保存先のそれぞれに作成する)
+# (.から始まるファイルは一覧に表示されない)
+INDEX_FILE = ".index.json"
+# 以前のバージョンでアップロードした動画のハッシュ値の記録ファイル名(索引に移行する)
+LEGACY_HASH_FILE = ".hashes.json"
+# 同じフォルダの索引を更新するプロセス間(画面とコマンドラインなど)で排他するためのファイル名
+LOCK_FILE = ".index.lock"
+
+# 索引ファイルの読み書きを排他する
+_lock = threading.Lock()
+# 索引ファイル名 => ((索引ファイルの更新時刻, iノード番号), 索引)
+_cache = {}
+
+
+def load_index(directory):
+    """索引の読み込み
+
+    索引ファイルが更新されていなければ、前回読み込んだ内容を返す
+
+    Args:
+        directory (str): 動画のアップロード先 or 解析結果の保存先
+
+    Returns:
+        dict: 名前 => メタ情報
+    """
+    with _locked(directory):
+        index = _read(directory)
+        return {name: dict(entry) for name, entry in index.items()}
+
+
+def update_entry(directory, name, **fields):
+    """索引の1件の更新
+
+    内容が変わらない場合は索引ファイルを書き込まない
+
+    Args:
+        directory (str): 動画のアップロード先 or 解析結果の保存先
+        name (str): 名前(ファイル名 or 結果フォルダ名)
+        **fields: 更新するメタ情報
+
+    Returns:
+        dict: 更新後のメタ情報
+    """
+    with _locked(directory):
+        index = _read(directory)
+        entry = index.get(name, {})
+        if any(entry.get(key) != value for key, value in fields.items()) or name not in index:
+            index = dict(index)
+            entry = dict(entry, **fields)
+            index[name] = entry
+            # 削除されたファイル・フォルダの記録は除く
+            index = {
+                key: value for key, value in index.items()
+                if os.path.exists(directory + key)
+            }
+            _write(directory, index)
+        return dict(entry)
+
+
+def list_videos(upload_dir=UPLOAD_DIR):
+    """アップロードした動画の一覧
+
+    索引にない動画・変更された動画は、このときに一度だけ調べて索引に追加する
+
+    Args:
+        upload_dir (str): 動画のアップロード先
+
+    Returns:
+        list(str): 動画ファイル名
+    """
+    if os.path.exists(upload_dir) is False:
+        return []
+    # 索引は一覧の作成ごとに一度だけ読み込み、各ファイルのサイズと更新時刻を照合する
+    index = load_index(upload_dir)
+    list_names = []
+    for entry in os.scandir(upload_dir):
+        if entry.is_file() is False or entry.name.startswith("."):
+            continue
+        list_names.append(entry.name)
+        info = index.get(entry.name, {})
+        if _is_current(info, entry.stat()) is False:
+            register_video(entry.name, _legacy_sha256(info), upload_dir)
+    return sorted(list_names)
+
+
+def get_video(name, upload_dir=UPLOAD_DIR):
+    """動画のメタ情報の取得
+
+    ファイルのサイズと更新時刻が索引と一致すれば、動画を開かずに索引の内容を返す
+
+    Args:
+        name (str): 動画ファイル名
+        upload_dir (str): 動画のアップロード先
+
+    Returns:
+        dict or None: メタ情報(probe_videoの内容とsha256, size, mtime)。動画がない場合はNone
+    """
+    try:
+        stat = os.stat(upload_dir + name)
+    except OSError:
+        return None
+    entry = load_index(upload_dir).get(name, {})
+    if _is_current(entry, stat):
+        return entry
+    return register_video(name, _legacy_sha256(entry), upload_dir)
+
+
+def register_video(name, sha256=None, upload_dir=UPLOAD_DIR):
+    """動画を調べて索引に登録する
+
+    Args:
+        name (str): 動画ファイル名
+        sha256 (str or None): 動画のハッシュ値(不明な場合はNone)
+        upload_dir (str): 動画のアップロード先
+
+    Returns:
+        dict: メタ情報
+    """
+    path = upload_dir + name
+    stat = os.stat(path)
+    return update_entry(
+        upload_dir, name,
+        sha256=sha256, size=stat.st_size, mtime=stat.st_mtime,
+        **probe_video(path))
+
+
+def probe_video(path):
+    """動画ファイルのチェックと動画情報の取得
+
+    Args:
+        path (str): 動画ファイルのパス
+
+    Returns:
+        dict: valid(読み込めるかどうか), error(エラーメッセージ),
+            nframe(フレーム数), fps(フレームレート), width(幅), height(高さ), duration(長さ[秒])
+    """
+    cap = cv2.VideoCapture(path)
+    try:
+        ret, emsg = analyzer.validate_video(cap)
+        if ret is False:
+            return {
+                "valid": False, "error": emsg,
+                "nframe": 0, "fps": 0.0, "width": 0, "height": 0, "duration": 0.0,
+            }
+        nframe, shape, fps = analyzer.get_video_info(cap)
+    finally:
+        cap.release()
+    return {
+        "valid": True, "error": None,
+        "nframe": nframe, "fps": fps, "width": shape[0], "height": shape[1],
+        "duration": nframe / fps if fps > 0 else 0.0,
+    }
+
+
+def video_sha256(path):
+    """動画ファイルのハッシュ値の取得
+
+    動画のあるフォルダに索引があり、サイズと更新時刻が一致するハッシュ値が記録されていれば、
+    ファイルを読まずにそれを返す(アップロードした動画は保存時に記録している)。
+    記録されていない場合は計算して索引に記録する。
+    索引のないフォルダ(コマンドラインで指定した任意のフォルダなど)では、索引を作らずに計算する。
+
+    Args:
+        path (str): 動画ファイルのパス
+
+    Returns:
+        str: ハッシュ値(SHA-256の16進数)
+    """
+    directory, name = os.path.split(path)
+    directory = os.path.join(directory, "")
+    if os.path.exists(directory + INDEX_FILE) is False:
+        return result_cache.file_sha256(path)
+    entry = get_video(name, directory)
+    if entry is not None and entry.get("sha256"):
+        return entry["sha256"]
+    digest = result_cache.file_sha256(path)
+    # 計算中に書き換えられていなければ記録する
+    stat = os.stat(path)
+    if entry is not None and _is_current(entry, stat):
+        update_entry(directory, name, sha256=digest)
+    return digest
+
+
+def get_result(name, results_dir=RESULTS_DIR):
+    """解析結果のメタ情報の取得
+
+    Args:
+        name (str): 結果フォルダ名
+        results_dir (str): 解析結果の保存先
+
+    Returns:
+        dict or None: メタ情報(status, video, nframe, fps, width, height, has_video)。索引にない場合はNone
+    """
+    return load_index(results_dir).get(name)
+
+
+def _is_current(entry, stat):
+    """索引のメタ情報が動画ファイルと一致するかどうか
+
+    Args:
+        entry (dict): 索引のメタ情報
+        stat (os.stat_result): 動画ファイルの情報
+
+    Returns:
+        bool: サイズと更新時刻が一致するかどうか
+    """
+    return entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime
+
+
+def _legacy_sha256(entry):
+    """以前のバージョンの記録から移行したハッシュ値
+
+    動画を調べ直すときも、移行したハッシュ値はそのまま使う
+
+    Args:
+        entry (dict): 索引のメタ情報
+
+    Returns:
+        str or None: 移行したハッシュ値(移行したものでない場合はNone)
+    """
+    return entry.get("sha256") if "size" not in entry else None
+
+
+@contextlib.contextmanager
+def _locked(directory):
+    """索引の排他
+
+    スレッド間に加えて、ファイルロックで他のプロセスとも排他する
+    (フォルダがない場合は索引もないため、スレッド間のみ排他する)
+
+    Args:
+        directory (str): 動画のアップロード先 or 解析結果の保存先
+
+    Yields:
+        なし
+    """
+    with _lock:
+        if os.path.isdir(directory) is False:
+            yield
+            return
+        with open(directory + LOCK_FILE, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read(directory):
+    """索引ファイルの読み込み(_lockedで排他してから呼ぶ)
+
+    Args:
+        directory (str): 動画のアップロード先 or 解析結果の保存先
+
+    Returns:
+        dict: 名前 => メタ情報(呼び出し側で変更しないこと)
+    """
+    filename = directory + INDEX_FILE
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return _migrate(directory)
+    # 他のプロセスが置き換えた場合はiノード番号が変わる(更新時刻の分解能が粗い場合のため)
+    version = (stat.st_mtime_ns, stat.st_ino)
+    cached = _cache.get(filename)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    try:
+        with open(filename) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        # 書き込み途中などで読めない場合は作り直す
+        index = {}
+    _cache[filename] = (version, index)
+    return index
+
+
+def _write(directory, index):
+    """索引ファイルの書き込み(_lockedで排他してから呼ぶ)
+
+    Args:
+        directory (str): 動画のアップロード先 or 解析結果の保存先
+        index (dict): 名前 => メタ情報
+    """
+    os.makedirs(directory, exist_ok=True)
+    filename = directory + INDEX_FILE
+    result_writer.write_json_atomic(filename, index)
+    stat = os.stat(filename)
+    _cache[filename] = ((stat.st_mtime_ns, stat.st_ino), index)
+
+
+def _migrate(directory):
+    """以前のバージョンのハッシュ値の記録を索引に移行する(_lockedで排他してから呼ぶ)
+
+    Args:
+        directory (str): 動画のアップロード先
+
+    Returns:
+        dict: 名前 => メタ情報
+    """
+    filename = directory + LEGACY_HASH_FILE
+    if os.path.exists(filename) is False:
+        return {}
+    try:
+        with open(filename) as f:
+            hashes = json.load(f)
+    except (OSError, ValueError):
+        hashes = {}
+    index = {name: {"sha256": digest} for name, digest in hashes.items()}
+    _write(directory, index)
+    os.remove(filename)
+    return index
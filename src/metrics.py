@@ -0,0 +1,163 @@
+import time
+import threading
+from collections import deque
+
+import numpy as np
+
+from const import METRICS_WINDOW
+
+
+# 計測結果のファイル名(解析結果フォルダ内に保存する)
+METRICS_FILE = "metrics.json"
+# Prometheusのメトリクス名の接頭辞
+PROMETHEUS_PREFIX = "hands_analysis_"
+
+
+class PipelineMetrics():
+    """解析の処理速度の計測
+
+    解析パイプラインの各ステージの処理時間と、フレームの処理が完了した時刻を記録し、
+    直近 window フレームの処理速度(fps)、ステージごとの処理時間の中央値・95パーセンタイル、
+    残り時間を求める。
+    各ステージのスレッドから同時に記録できる。
+    """
+    def __init__(self, nframe=0, window=METRICS_WINDOW):
+        """コンストラクタ
+
+        Args:
+            nframe (int): 動画のフレーム数
+            window (int): 処理速度・処理時間を求める直近のフレーム数
+        """
+        self.nframe = nframe
+        self.processed = 0
+        self.window = window
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        # ステージ名 => 直近の処理時間[秒]
+        self._latency = {}
+        # ステージ名 => 処理したフレーム数, 処理時間の合計[秒]
+        self._count = {}
+        self._sum = {}
+        # 直近のフレームの処理が完了した時刻
+        self._done_times = deque(maxlen=window)
+
+    def add(self, stage, seconds):
+        """処理時間の記録
+
+        Args:
+            stage (str): ステージ名
+            seconds (float): 1フレームの処理時間[秒]
+
+        Returns:
+            なし
+        """
+        with self._lock:
+            if stage not in self._latency:
+                self._latency[stage] = deque(maxlen=self.window)
+                self._count[stage] = 0
+                self._sum[stage] = 0.0
+            self._latency[stage].append(seconds)
+            self._count[stage] += 1
+            self._sum[stage] += seconds
+
+    def frame_done(self, processed, nframe=None):
+        """フレームの処理の完了の記録
+
+        Args:
+            processed (int): 処理が完了したフレーム数(前回までに完了したフレームを含む)
+            nframe (int or None): 動画のフレーム数(Noneの場合は変更しない)
+
+        Returns:
+            なし
+        """
+        with self._lock:
+            self._done_times.append(time.monotonic())
+            self.processed = processed
+            if nframe is not None:
+                self.nframe = nframe
+
+    def snapshot(self):
+        """計測結果の取得
+
+        Returns:
+            dict: processed(完了したフレーム数), nframe(フレーム数), elapsed_s(経過時間[秒]),
+                fps(直近の処理速度。求められない場合はNone), eta_s(残り時間[秒]。求められない場合はNone),
+                stages(ステージ名 => count, total_s, p50_ms, p95_ms)
+        """
+        with self._lock:
+            done_times = list(self._done_times)
+            latency = {stage: np.array(values, dtype=np.float64) for stage, values in self._latency.items()}
+            count = dict(self._count)
+            total = dict(self._sum)
+            processed = self.processed
+            nframe = self.nframe
+
+        fps = None
+        if len(done_times) >= 2 and done_times[-1] > done_times[0]:
+            fps = (len(done_times) - 1) / (done_times[-1] - done_times[0])
+        eta = (nframe - processed) / fps if fps and nframe > processed else None
+        stages = {}
+        for stage, values in latency.items():
+            stages[stage] = {
+                "count": count[stage],
+                "total_s": total[stage],
+                "p50_ms": float(np.percentile(values, 50) * 1000),
+                "p95_ms": float(np.percentile(values, 95) * 1000),
+            }
+        return {
+            "processed": processed,
+            "nframe": nframe,
+            "elapsed_s": time.monotonic() - self._started,
+            "fps": fps,
+            "eta_s": eta,
+            "stages": stages,
+        }
+
+
+def to_prometheus(dict_snapshots):
+    """計測結果のPrometheusのテキスト形式への変換
+
+    Args:
+        dict_snapshots (dict): ジョブの名前 => PipelineMetrics.snapshotの結果
+
+    Returns:
+        str: Prometheusのテキスト形式
+    """
+    gauges = [
+        ("processed_frames", "Number of frames analysed so far", "processed"),
+        ("total_frames", "Number of frames in the video", "nframe"),
+        ("elapsed_seconds", "Seconds since the analysis started", "elapsed_s"),
+        ("fps", "Recent analysis throughput in frames per second", "fps"),
+        ("eta_seconds", "Estimated seconds until the analysis finishes", "eta_s"),
+    ]
+    lines = []
+    for name, help_text, key in gauges:
+        lines.append("# HELP %s%s %s" % (PROMETHEUS_PREFIX, name, help_text))
+        lines.append("# TYPE %s%s gauge" % (PROMETHEUS_PREFIX, name))
+        for job, snapshot in sorted(dict_snapshots.items()):
+            if snapshot.get(key) is not None:
+                lines.append('%s%s{job="%s"} %s' % (PROMETHEUS_PREFIX, name, _escape(job), float(snapshot[key])))
+
+    name = PROMETHEUS_PREFIX + "stage_latency_seconds"
+    lines.append("# HELP %s Per-frame processing time of each pipeline stage (recent frames)" % name)
+    lines.append("# TYPE %s summary" % name)
+    for job, snapshot in sorted(dict_snapshots.items()):
+        for stage, dict_stage in sorted(snapshot.get("stages", {}).items()):
+            labels = 'job="%s",stage="%s"' % (_escape(job), _escape(stage))
+            lines.append('%s{%s,quantile="0.5"} %s' % (name, labels, dict_stage["p50_ms"] / 1000))
+            lines.append('%s{%s,quantile="0.95"} %s' % (name, labels, dict_stage["p95_ms"] / 1000))
+            lines.append('%s_sum{%s} %s' % (name, labels, float(dict_stage["total_s"])))
+            lines.append('%s_count{%s} %d' % (name, labels, dict_stage["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    """Prometheusのラベルの値のエスケープ
+
+    Args:
+        value (str): ラベルの値
+
+    Returns:
+        str: エスケープした値
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
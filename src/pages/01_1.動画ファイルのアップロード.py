@@ -2,7 +2,9 @@ import os
 
 import streamlit as st
 
-from const import UPLOAD_DIR
+import upload_store
+import shared_resources
+from const import UPLOAD_DIR, UPLOAD_MAX_BYTES
 
 
 # 動画のアップロード先
@@ -11,6 +13,11 @@ if os.path.exists(UPLOAD_DIR) is False:
 
 
 def main():
+    # ダウンロード用サーバー(全ユーザーで共有)
+    shared_resources.load_download_server()
+    # 解析ジョブの管理クラス(全ユーザーで共有。前回の起動時に完了しなかったジョブを再開する)
+    shared_resources.load_job_manager()
+
     # 動画のアップロード
     st.markdown("## 1. 動画ファイルのアップロード")
     uploaded_file = st.file_uploader(
@@ -18,11 +25,16 @@ def main():
         type=["mp4"])
 
     if uploaded_file is not None:
-        # ファイルの保存
         name = uploaded_file.name
-        dst = UPLOAD_DIR + name
-        with open(dst, 'wb') as f:
-            f.write(uploaded_file.getbuffer())
+        # 画面の再実行のたびに同じファイルを保存し直さない
+        if st.session_state.get("uploaded_file_id") != uploaded_file.file_id:
+            # ファイルの保存
+            try:
+                upload_store.save_upload(uploaded_file, name)
+            except upload_store.UploadTooLargeError:
+                st.warning("ファイルサイズが上限(%dMB)を超えています。" % (UPLOAD_MAX_BYTES // 1024 ** 2))
+                return
+            st.session_state["uploaded_file_id"] = uploaded_file.file_id
         st.success("「%s」のアップロードに成功しました。" % name)
 
 
@@ -1,14 +1,12 @@
 import os
-import glob
-import threading
-import json
+import time
 
-import cv2
 import streamlit as st
 
-import hands_detector
-import video_writer
-from const import UPLOAD_DIR, RESULTS_DIR
+import job_manager
+import media_index
+import shared_resources
+from const import UPLOAD_DIR, RESULTS_DIR, DETECT_INTERVAL, PROGRESS_UPDATE_HZ
 
 
 # 解析結果の保存先
@@ -16,79 +14,30 @@ if os.path.exists(RESULTS_DIR) is False:
     os.mkdir(RESULTS_DIR)
 
 
-class AiModel():
-    """AIモデルのクラス
-
-    この例では手のひら検知を行う
-    """
-    def __init__(self):
-        """コンストラクタ
-        """
-        # 手のひら検知
-        self.detector = hands_detector.HandsDetector()
-        # ユーザー間の排他ロック
-        self.lock = threading.Lock()
-
-    def try_lock(self):
-        """ロック獲得関数
-
-        Args:
-            なし
-
-        Returns:
-            bool: 獲得成功 or 失敗
-        """
-        ret = self.lock.acquire(timeout=0)
-        return ret
-
-    def unlock(self):
-        """ロック解放関数
-
-        Args:
-            なし
-
-        Returns:
-            なし
-
-        Raises:
-            獲得していないのに解放しようとするとエラーになる
-        """
-        self.lock.release()
-
-    def detect(self, image_rgb):
-        """検出関数
-
-        Args:
-            image_rgb (ndarray((height, width, 3), dtype=np.uint8)):
-                RGR画像
-
-        Returns:
-            list(dict): 検出結果,
-            ndarray((height, width, 3), dtype=np.uint8): 描画画像(RGB)
-        """
-        return self.detector.detect(image_rgb)
-
-
-# st.cache_resourceの戻り値はユーザー間で共有される
-# => AIオブジェクトは全ユーザーで共有される
-@st.cache_resource
-def load_model():
-    AI = AiModel()
-    return AI
+# 解析状況の表示を更新する間隔[秒]
+POLL_INTERVAL = 1 / PROGRESS_UPDATE_HZ
 
 
 def main():
-    # AIモデル(全ユーザーで共有)
-    AI = load_model()
+    # ダウンロード用サーバー(全ユーザーで共有)
+    shared_resources.load_download_server()
+
+    # 解析ジョブの管理クラス(全ユーザーで共有)
+    JM = shared_resources.load_job_manager()
 
     # 動画の選択
     st.markdown("## 2. 解析の実行")
-    list_videos = glob.glob(UPLOAD_DIR + "*")
-    list_videos = [v[len(UPLOAD_DIR):] for v in list_videos]
+    # 動画の情報は索引から取得する(動画ファイルは開かない)
+    list_videos = media_index.list_videos(UPLOAD_DIR)
     target_video = st.selectbox(
         "解析する動画",
         list_videos,
         index=None, placeholder="動画を選択してください")
+    if target_video:
+        info = media_index.get_video(target_video, UPLOAD_DIR)
+        if info is not None and info["valid"]:
+            st.caption("%d x %d, %.2f fps, %d フレーム(%.1f 秒)" % (
+                info["width"], info["height"], info["fps"], info["nframe"], info["duration"]))
     play_button = st.button("選択した動画を再生する")
     if play_button:
         if not target_video:
@@ -100,106 +49,186 @@ def main():
 
     # 解析
     st.divider()  # 下に線を引く
+    options, segments = _select_options()
     analyze_button = st.button("解析実行！！")
     if analyze_button:
         # 動画ファイルの選択チェック
         if not target_video:
             st.warning("解析する動画ファイルを選択してください。")
         else:
-            cap = cv2.VideoCapture(UPLOAD_DIR + target_video)
-            lock_ok = AI.try_lock()
-            try:
-                # 動画ファイルのチェック
-                ret, emsg = _validate_video(cap)
-                if ret is False:
-                    st.warning(emsg)
-                elif lock_ok is False:
-                    st.warning("他のユーザーが使用中です。しばらくお待ちください")
-                else:
-                    # 解析開始
-                    name = target_video.rsplit(".", maxsplit=1)[0]
-                    outdir = RESULTS_DIR + name
-                    if os.path.exists(outdir) is False:
-                        os.mkdir(outdir)
-                    nframe, shape, fps = _get_video_info(cap)
-                    writer = video_writer.VideoWriter(
-                        outdir + "/result.mp4", "h264", fps, shape)
-                    list_results = []
-                    progress = st.progress(0, text="解析中 ...")
-                    for iframe in range(nframe):  # 解析ループ
-                        ret, image = cap.read()
-                        if ret is False:
-                            # 解析終了
-                            break
-                        # 解析実行
-                        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                        results, drawn_image = AI.detect(image_rgb)
-                        list_results.append({
-                            "FrameNumber": iframe,
-                            "Results": results
-                        })
-                        writer.write(drawn_image)
-                        # 進捗バーの更新
-                        percent = iframe / nframe
-                        progress.progress(percent, text="解析中...")
-
-                    # 終了処理
-                    writer.release()
-                    with open(outdir + "/result.json", "w") as f:
-                        json.dump(list_results, f)
-                    progress.progress(1.0, text="解析完了")
-                    st.success("解析が完了しました。")
-
-            finally:
-                cap.release()
-                if lock_ok is True:
-                    AI.unlock()
-
-
-def _validate_video(cap):
-    """動画ファイルのチェック
+            # 動画ファイルのチェック
+            info = media_index.get_video(target_video, UPLOAD_DIR)
+            if info is None or info["valid"] is False:
+                st.warning(info["error"] if info is not None else "動画ファイルが見つかりません。")
+            else:
+                try:
+                    job_id = JM.submit(target_video, options, segments)
+                    st.session_state.setdefault("job_ids", []).append(job_id)
+                    st.success("解析を受け付けました。画面を閉じても解析は続行されます。")
+                except job_manager.JobConflictError:
+                    st.warning("この動画は解析中です。完了までお待ちください。")
+
+    # 解析状況
+    st.divider()  # 下に線を引く
+    st.markdown("### 解析状況")
+    _show_jobs(JM)
+
+
+def _select_options():
+    """解析の設定を選択する関数
+
+    推論するフレームを間引くと、間引いたフレームの座標は前後のフレームから補間される。
+    解析結果の動画は、プレビュー用(高速)・保存用(高画質)・作成しない から選ぶ。
+    並列数を2以上にすると、動画を分割して複数のプロセスで同時に解析する。
+
+    Args:
+        なし
+
+    Returns:
+        dict: 解析の設定
+        int: 並列数
+    """
+    with st.expander("解析の設定"):
+        sampling = st.radio(
+            "推論するフレーム",
+            ["すべてのフレーム", "一定間隔", "手の動きに応じて自動"],
+            horizontal=True)
+        interval = st.number_input(
+            "推論の間隔(自動の場合は間隔の上限)",
+            min_value=2, value=DETECT_INTERVAL, step=1,
+            disabled=sampling == "すべてのフレーム")
+        dict_video = {
+            "プレビュー用(高速)": "preview",
+            "保存用(高画質)": "archive",
+            "作成しない(座標のみ)": None,
+        }
+        video = st.radio("解析結果の動画", list(dict_video), horizontal=True)
+        segments = st.number_input(
+            "並列数(長い動画を分割して同時に解析するプロセス数)",
+            min_value=1, max_value=os.cpu_count() or 1, value=1, step=1)
+    options = {
+        "detect_interval": 1 if sampling == "すべてのフレーム" else int(interval),
+        "adaptive": sampling == "手の動きに応じて自動",
+        "video": dict_video[video],
+    }
+    return options, int(segments)
+
+
+def _show_jobs(JM):
+    """解析ジョブの状況を表示する関数
+
+    実行中・待機中のジョブと、このセッションで投入したジョブを表示し、
+    すべて終わるまで定期的に表示を更新する。
+    表示する内容が変わらない間は、画面に送信しない。
 
     Args:
-        cap (cv2.VideoCapture):
-            ビデオキャプチャーオブジェクト
+        JM (job_manager.JobManager):
+            解析ジョブの管理クラス
 
     Returns:
-        bool:
-            チェックの結果
-        str or None:
-            エラーメッセージ
+        なし
     """
-    emsg = \
-        "動画ファイルの読み込みに失敗しました。  \n" + \
-        "ファイル形式がサポートされていないか、ファイル拡張子が正しくないか、" + \
-        "ファイルが破損している可能性があります。"
-    if cap.isOpened() is False:
-        return False, emsg
+    show_preview = st.checkbox("解析中の画像を表示する")
+    placeholder = st.empty()
+    last_state = None
+    while True:
+        my_job_ids = st.session_state.get("job_ids", [])
+        list_jobs = [
+            job for job in JM.list_jobs()
+            if job["status"] in (job_manager.QUEUED, job_manager.RUNNING) or job["id"] in my_job_ids
+        ]
+        state = [
+            (job["id"], job["status"], job["processed"], JM.position(job["id"]),
+             _preview_frame(JM, job) if show_preview else None)
+            for job in list_jobs
+        ]
+        if state != last_state:
+            with placeholder.container():
+                if len(list_jobs) == 0:
+                    st.write("実行中の解析はありません。")
+                for job in list_jobs:
+                    _show_job(JM, job, show_preview)
+            last_state = state
+        if all(job["status"] in (job_manager.DONE, job_manager.FAILED) for job in list_jobs):
+            break
+        time.sleep(POLL_INTERVAL)
+
+
+def _preview_frame(JM, job):
+    """表示するプレビュー画像のフレーム番号を取得する関数
 
-    nframe = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    if nframe <= 0:
-        return False, emsg
+    Args:
+        JM (job_manager.JobManager):
+            解析ジョブの管理クラス
+        job (dict):
+            ジョブの状態
+
+    Returns:
+        int or None: フレーム番号(プレビュー画像がない場合はNone)
+    """
+    preview = JM.get_preview(job["id"])
+    return preview[0] if preview is not None else None
 
-    return True, None
 
+def _show_job(JM, job, show_preview=False):
+    """1件の解析ジョブの状況を表示する関数
 
-def _get_video_info(cap):
-    """動画情報の取得
+    Args:
+        JM (job_manager.JobManager):
+            解析ジョブの管理クラス
+        job (dict):
+            ジョブの状態
+        show_preview (bool):
+            解析中の画像を表示するかどうか
+
+    Returns:
+        なし
+    """
+    st.write("「%s」(ID: %s)" % (job["video"], job["id"]))
+    if job["status"] == job_manager.QUEUED:
+        position = JM.position(job["id"])
+        wait = JM.estimate_wait(job["id"])
+        text = "順番待ちです。"
+        if position is not None:
+            text += "(あと%d件)" % (position + 1)
+        if wait is not None:
+            text += "  \n推定待ち時間: 約%d秒" % wait
+        st.info(text)
+    elif job["status"] == job_manager.RUNNING:
+        percent = job["processed"] / job["nframe"] if job["nframe"] > 0 else 0.0
+        st.progress(min(percent, 1.0), text="解析中... (%d / %d)" % (job["processed"], job["nframe"]))
+        snapshot = JM.get_metrics(job["id"])
+        if snapshot is not None and snapshot["fps"] is not None:
+            st.caption(_format_metrics(snapshot))
+        preview = JM.get_preview(job["id"]) if show_preview else None
+        if preview is not None:
+            st.image(preview[1], caption="%dフレーム目" % (preview[0] + 1))
+    elif job["status"] == job_manager.DONE:
+        st.success("解析が完了しました。")
+    else:
+        st.error("解析に失敗しました。  \n%s" % job["error"])
+
+
+def _format_metrics(snapshot):
+    """処理速度の表示用の文字列を作る関数
 
     Args:
-        cap (cv2.VideoCapture):
-            ビデオキャプチャーオブジェクト
+        snapshot (dict):
+            metrics.PipelineMetrics.snapshotの結果
 
     Returns:
-        int: フレーム数
-        tuple(int. int): 幅,高さ
-        float: フレームレート
+        str: 処理速度・残り時間・ステージごとの処理時間
     """
-    nframe = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    return nframe, (width, height), fps
+    text = "処理速度: %.1f fps" % snapshot["fps"]
+    if snapshot["eta_s"] is not None:
+        text += " / 残り時間: 約%d秒" % snapshot["eta_s"]
+    stages = [
+        "%s %.1fms (p95 %.1fms)" % (stage, dict_stage["p50_ms"], dict_stage["p95_ms"])
+        for stage, dict_stage in snapshot["stages"].items()
+    ]
+    if stages:
+        text += "  \n" + " / ".join(stages)
+    return text
 
 
 if __name__ == "__main__":
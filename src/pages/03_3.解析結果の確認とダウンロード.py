@@ -1,26 +1,40 @@
 import os
-import glob
-import shutil
-import base64
+import io
 import json
 from fractions import Fraction
 
 import streamlit as st
+import streamlit.components.v1 as components
+import numpy as np
 import pandas as pd
 import cv2
 import matplotlib.pyplot as plt
 import japanize_matplotlib
 import seaborn as sns
 
-from const import RESULTS_DIR
+import job_manager
+import media_index
+import landmark_store
+import download_server
+import shared_resources
+import result_reader
+import plot_utils
+from const import RESULTS_DIR, FAST_PLOT_THRESHOLD, FAST_PLOT_MAX_POINTS, FAST_PLOT_DENSITY_BINS
+from const import PLOT_CACHE_MAX_ENTRIES
+from const import DOWNLOAD_PUBLIC_PORT
 
 
 def main():
+    # ダウンロード用サーバー(全ユーザーで共有)
+    shared_resources.load_download_server()
+    # 解析ジョブの管理クラス(全ユーザーで共有。前回の起動時に完了しなかったジョブを再開する)
+    shared_resources.load_job_manager()
+
     # 結果の確認とダウンロード
     st.markdown("## 3. 解析結果の確認とダウンロード")
 
-    list_results = glob.glob(RESULTS_DIR + "*")
-    list_results = [r[len(RESULTS_DIR):] for r in list_results]
+    # 解析が完了した結果のみを表示する
+    list_results = job_manager.list_finished_results(RESULTS_DIR)
 
     target_result = st.selectbox(
         "確認する結果",
@@ -33,8 +47,12 @@ def main():
         if not target_result:
             st.warning("確認する結果を選択してください。")
         else:
-            with open(RESULTS_DIR + target_result + "/result.mp4", "rb") as f:
-                st.video(f, format="video/mp4", start_time=0)
+            filename = RESULTS_DIR + target_result + "/result.mp4"
+            if os.path.exists(filename) is False:
+                st.warning("この結果には動画がありません。(動画を作成しない設定で解析されました)")
+            else:
+                with open(filename, "rb") as f:
+                    st.video(f, format="video/mp4", start_time=0)
 
     # ダウンロード
     download_result_button = st.button("ダウンロードする")
@@ -42,123 +60,238 @@ def main():
         if not target_result:
             st.warning("確認する結果を選択してください。")
         else:
-            st.write("ダウンロードリンクを作成中です...")
-            download_link = _create_download_zip(
-                RESULTS_DIR + target_result, target_result + ".zip")
-            st.markdown(download_link, unsafe_allow_html=True)
+            _show_download_link(target_result)
 
     # 表・グラフの可視化
+    with st.expander("可視化するフレームの範囲"):
+        start_frame = st.number_input("開始フレーム", min_value=0, value=0, step=1)
+        stop_frame = st.number_input("終了フレーム(0の場合は最後まで)", min_value=0, value=0, step=1)
+        frame_step = st.number_input("間引き間隔", min_value=1, value=1, step=1)
     plot_button = st.button("表・グラフで可視化する")
     if plot_button:
         if not target_result:
             st.warning("確認する結果を選択してください。")
         else:
-            dict_data = _read_data(
-                RESULTS_DIR + target_result + "/result.json")
-            width, height, wnorm, hnorm = _get_video_shape(
-                RESULTS_DIR + target_result + "/result.mp4")
-            list_target = ["親指", "人差し指", "中指", "薬指", "小指"]
-            for target, tab in zip(list_target, st.tabs(list_target)):
-                with tab:
-                    list_which_hand = ["右手", "左手"]
-                    dict_df = {
-                        which: pd.DataFrame(dict_data[which][target], columns=["x座標", "y座標"])
-                        for which in list_which_hand
-                    }
-                    with st.expander("要約統計量"):
-                        for which, col in zip(list_which_hand,
-                                              st.columns(len(list_which_hand))):
-                            with col:
-                                st.write(which)
-                                df = dict_df[which]
-                                st.dataframe(df.describe())
-                    with st.expander("軌跡"):
-                        for which, col in zip(list_which_hand,
-                                              st.columns(len(list_which_hand))):
-                            with col:
-                                st.write(which)
-                                df = dict_df[which]
-                                plt.plot(df["x座標"], df["y座標"], marker="o")
-                                plt.xlim(0, width)
-                                plt.ylim(height, 0)
-                                plt.xlabel("x座標", fontsize=20)
-                                plt.ylabel("y座標", fontsize=20)
-                                plt.tick_params(labelsize=18)
-                                st.pyplot(plt)
-                                plt.clf()
-                    with st.expander("密度分布"):
-                        for which, col in zip(list_which_hand,
-                                              st.columns(len(list_which_hand))):
-                            with col:
-                                st.write(which)
-                                df = dict_df[which]
-                                plot = sns.jointplot(x="x座標", y="y座標", kind="kde", color="C3", data=df, fill=True)
-                                plt.xlim(0, width)
-                                plt.ylim(height, 0)
-                                plt.xlabel("x座標", fontsize=20)
-                                plt.ylabel("y座標", fontsize=20)
-                                plt.tick_params(labelsize=18)
-                                plot.fig.set_figwidth(wnorm)
-                                plot.fig.set_figheight(hnorm)
-                                st.pyplot(plot)
-                                plt.clf()
-
-
-def _create_download_zip(zip_directory, filename):
-    """結果をzipにしてダウンロードリンクを返す関数
+            # 画面が再実行されても(表示する指を切り替えても)続けて表示する
+            st.session_state["plot_result"] = target_result
+    if target_result and st.session_state.get("plot_result") == target_result:
+        _show_plots(
+            RESULTS_DIR + target_result,
+            start_frame, stop_frame if stop_frame > 0 else None, frame_step)
+
+
+def _show_plots(result_dir, start, stop, step):
+    """表・グラフを表示する関数
+
+    選択された指・表示内容のみを描画する。
+    要約統計量と図は解析結果ごとにキャッシュするため、2回目以降は描画し直さない。
+
+    Args:
+        result_dir (str):
+            結果フォルダのパス
+        start (int):
+            可視化する最初のフレーム番号
+        stop (int or None):
+            可視化する最後のフレーム番号+1(Noneの場合は最後まで)
+        step (int):
+            可視化するフレームの間隔
+
+    Returns:
+        なし
+    """
+    mtime = result_reader.result_mtime(result_dir)
+    width, height, wnorm, hnorm = _get_video_shape(result_dir)
+    list_target = ["親指", "人差し指", "中指", "薬指", "小指"]
+    target = st.radio("指", list_target, horizontal=True)
+    view = st.radio("表示内容", ["要約統計量", "軌跡", "密度分布"], horizontal=True)
+    list_which_hand = ["右手", "左手"]
+    for which, col in zip(list_which_hand, st.columns(len(list_which_hand))):
+        with col:
+            st.write(which)
+            if view == "要約統計量":
+                st.dataframe(_describe(result_dir, mtime, start, stop, step, which, target))
+            elif view == "軌跡":
+                st.image(_plot_trajectory(
+                    result_dir, mtime, start, stop, step, which, target, width, height))
+            else:
+                st.image(_plot_density(
+                    result_dir, mtime, start, stop, step, which, target, width, height, wnorm, hnorm))
+
+
+def _get_dataframe(result_dir, mtime, start, stop, step, which, target):
+    """指先の座標をデータフレームにする関数
+
+    Args:
+        result_dir (str): 結果フォルダのパス
+        mtime (float): 解析結果の更新時刻
+        start (int): 最初のフレーム番号
+        stop (int or None): 最後のフレーム番号+1
+        step (int): フレームの間隔
+        which (str): 右手 or 左手
+        target (str): 指
+
+    Returns:
+        pandas.DataFrame: x座標, y座標
+    """
+    dict_data = _load_fingertips(result_dir, mtime, start, stop, step)
+    return pd.DataFrame(dict_data[which][target], columns=["x座標", "y座標"])
+
+
+@st.cache_data(max_entries=PLOT_CACHE_MAX_ENTRIES)
+def _describe(result_dir, mtime, start, stop, step, which, target):
+    """要約統計量を計算する関数(キャッシュ付き)
+
+    Args:
+        _get_dataframeと同じ
+
+    Returns:
+        pandas.DataFrame: 要約統計量
+    """
+    df = _get_dataframe(result_dir, mtime, start, stop, step, which, target)
+    return df.describe()
+
+
+@st.cache_data(max_entries=PLOT_CACHE_MAX_ENTRIES)
+def _plot_trajectory(result_dir, mtime, start, stop, step, which, target, width, height):
+    """軌跡を描画する関数(キャッシュ付き)
+
+    点の数がFAST_PLOT_THRESHOLDを超える場合は、間引いてから描画する
+
+    Args:
+        _get_dataframeと同じ
+        width (int): 動画の幅
+        height (int): 動画の高さ
+
+    Returns:
+        bytes: PNG画像
+    """
+    df = _get_dataframe(result_dir, mtime, start, stop, step, which, target)
+    fig = plt.figure()
+    if len(df) > FAST_PLOT_THRESHOLD:
+        # 点が多い場合は形状を保ったまま間引き、マーカーは描かない
+        xy = plot_utils.lttb(df.to_numpy(), FAST_PLOT_MAX_POINTS)
+        plt.plot(xy[:, 0], xy[:, 1])
+    else:
+        plt.plot(df["x座標"], df["y座標"], marker="o")
+    plt.xlim(0, width)
+    plt.ylim(height, 0)
+    plt.xlabel("x座標", fontsize=20)
+    plt.ylabel("y座標", fontsize=20)
+    plt.tick_params(labelsize=18)
+    return _to_png(fig)
+
+
+@st.cache_data(max_entries=PLOT_CACHE_MAX_ENTRIES)
+def _plot_density(result_dir, mtime, start, stop, step, which, target, width, height, wnorm, hnorm):
+    """密度分布を描画する関数(キャッシュ付き)
+
+    点の数がFAST_PLOT_THRESHOLDを超える場合は、平滑化したヒストグラムで近似する
+
+    Args:
+        _get_dataframeと同じ
+        width (int): 動画の幅
+        height (int): 動画の高さ
+        wnorm (int): 幅の比
+        hnorm (int): 高さの比
+
+    Returns:
+        bytes: PNG画像
+    """
+    df = _get_dataframe(result_dir, mtime, start, stop, step, which, target)
+    if len(df) > FAST_PLOT_THRESHOLD:
+        # 点が多い場合はカーネル密度推定の代わりに、平滑化したヒストグラムを描く
+        grid = plot_utils.density_grid(df.to_numpy(), width, height, FAST_PLOT_DENSITY_BINS)
+        xs = (np.arange(grid.shape[1]) + 0.5) * width / grid.shape[1]
+        ys = (np.arange(grid.shape[0]) + 0.5) * height / grid.shape[0]
+        plot = sns.JointGrid()
+        plot.ax_joint.imshow(grid, extent=(0, width, height, 0), cmap="Reds", aspect="auto")
+        plot.ax_marg_x.fill_between(xs, grid.sum(axis=0), color="C3", alpha=0.5)
+        plot.ax_marg_y.fill_betweenx(ys, grid.sum(axis=1), color="C3", alpha=0.5)
+        plt.sca(plot.ax_joint)
+    else:
+        plot = sns.jointplot(x="x座標", y="y座標", kind="kde", color="C3", data=df, fill=True)
+    plt.xlim(0, width)
+    plt.ylim(height, 0)
+    plt.xlabel("x座標", fontsize=20)
+    plt.ylabel("y座標", fontsize=20)
+    plt.tick_params(labelsize=18)
+    plot.fig.set_figwidth(wnorm)
+    plot.fig.set_figheight(hnorm)
+    return _to_png(plot.fig)
+
+
+def _to_png(fig):
+    """図をPNG画像に変換する関数
+
+    Args:
+        fig (matplotlib.figure.Figure): 図
+
+    Returns:
+        bytes: PNG画像
+    """
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight")
+    plt.close(fig)
+    return buf.getvalue()
+
+
+def _show_download_link(name):
+    """ダウンロードリンクを表示する関数
 
     streamlitのdownloadボタンは、あらかじめファイルをメモリにロードする必要があり、
     メモリを無駄に消費してしまう。
+    そのため、解析結果をzipにしながら送信するダウンロード用サーバーへのリンクを表示する。
+    解析結果のJSONのみをダウンロードするリンクも表示する(配列形式の解析結果から変換しながら送信する)。
 
-    この関数は、streamlitでなくHTMLでダウンロードするためのリンクを渡す関数
+    ダウンロード用サーバーはstreamlitと別のポートで動いているため、
+    ブラウザでアクセスしているホスト名からリンクを組み立てる。
 
     Args:
-        zip_directory (str):
-            zipにしたいフォルダ名
-        filename (str):
-            ユーザーがダウンロードするときのファイル名
+        name (str):
+            結果のフォルダ名
 
     Returns:
-        str: HTMLのリンク
+        なし
     """
-    shutil.make_archive(zip_directory, 'zip', zip_directory)
-    with open(zip_directory + ".zip", 'rb') as f:
-        b64 = base64.b64encode(f.read()).decode()
-    href = f'<a href="data:file/zip;base64,{b64}" download=\'{filename}\'>\
-            クリックしてダウンロードする \
-        </a>'
-    os.remove(zip_directory + ".zip")
-    return href
+    path = download_server.download_path(name)
+    path_json = download_server.download_path(name, ".json")
+    components.html(f"""
+        <a id="download" href="#" target="_blank" style="font-family: sans-serif;">
+            クリックしてダウンロードする
+        </a>
+        <span style="font-family: sans-serif;">/</span>
+        <a id="download_json" href="#" target="_blank" style="font-family: sans-serif;">
+            JSONのみ
+        </a>
+        <script>
+            const loc = window.parent.location;
+            const base = loc.protocol + "//" + loc.hostname + ":" + {DOWNLOAD_PUBLIC_PORT};
+            document.getElementById("download").href = base + {json.dumps(path)};
+            document.getElementById("download_json").href = base + {json.dumps(path_json)};
+        </script>
+        """, height=40)
 
 
-def _read_data(filename):
-    """結果JSONを読み込む関数
+@st.cache_data(max_entries=16)
+def _load_fingertips(result_dir, mtime, start, stop, step):
+    """指先の座標を読み込む関数(キャッシュ付き)
 
     Args:
-        filename (str):
-            結果ファイルのパス
+        result_dir (str):
+            結果フォルダのパス
+        mtime (float):
+            解析結果の更新時刻(キャッシュのキーとしてのみ使う)
+        start (int):
+            読み込む最初のフレーム番号
+        stop (int or None):
+            読み込む最後のフレーム番号+1
+        step (int):
+            読み込むフレームの間隔
 
     Returns:
         dict:
-            結果JSON
+            左右 => 指 => 座標の配列
     """
-    # 指先のデータを取得する
-    dict_data = {
-        "右手": {
-            "親指": [],
-            "人差し指": [],
-            "中指": [],
-            "薬指": [],
-            "小指": []
-        },
-        "左手": {
-            "親指": [],
-            "人差し指": [],
-            "中指": [],
-            "薬指": [],
-            "小指": []
-        }
-    }
     en2jp = {
         "Right": "右手",
         "Left": "左手",
@@ -168,29 +301,31 @@ def _read_data(filename):
         "RING_FINGER_TIP": "薬指",
         "PINKY_TIP": "小指"
     }
+    # 指先のデータを取得する
+    dict_landmarks = result_reader.read_landmarks(
+        result_dir,
+        ["THUMB_TIP",
+         "INDEX_FINGER_TIP",
+         "MIDDLE_FINGER_TIP",
+         "RING_FINGER_TIP",
+         "PINKY_TIP"],
+        start, stop, step)
+    return {
+        en2jp[which]: {en2jp[key]: xy for key, xy in dict_key.items()}
+        for which, dict_key in dict_landmarks.items()
+    }
 
-    with open(filename) as f:
-        list_results = json.load(f)
-    for results in list_results:
-        for result in results["Results"]:
-            cateory_name = result["CategoryName"]
-            for key in ["THUMB_TIP",
-                        "INDEX_FINGER_TIP",
-                        "MIDDLE_FINGER_TIP",
-                        "RING_FINGER_TIP",
-                        "PINKY_TIP"]:
-                xy = result["Coordinates"][key]
-                dict_data[en2jp[cateory_name]][en2jp[key]].append(xy)
-
-    return dict_data
 
+def _get_video_shape(result_dir):
+    """動画の解像度を取得する関数
 
-def _get_video_shape(filename):
-    """動画ファイルの解像度を取得する関数
+    解析結果の索引に記録されていればそこから取得する。
+    なければ配列形式の解析結果のメタ情報から取得する(result.mp4がない場合もある)。
+    どちらもなければ result.mp4 から取得する。
 
     Args:
-        filename (str):
-            動画ファイルのパス
+        result_dir (str):
+            結果フォルダのパス
 
     Returns:
         int: 幅
@@ -198,10 +333,20 @@ def _get_video_shape(filename):
         int: 幅の比
         int: 高さの比
     """
-    cap = cv2.VideoCapture(filename)
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    cap.release()
+    name = os.path.basename(result_dir)
+    info = media_index.get_result(name, os.path.dirname(result_dir) + "/") or {}
+    if info.get("width") and info.get("height"):
+        width = info["width"]
+        height = info["height"]
+    elif landmark_store.has_store(result_dir):
+        meta = landmark_store.LandmarkStore(result_dir).meta
+        width = meta["width"]
+        height = meta["height"]
+    else:
+        cap = cv2.VideoCapture(result_dir + "/result.mp4")
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        cap.release()
 
     tmp = Fraction(width, height)
 
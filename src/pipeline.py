@@ -0,0 +1,320 @@
+import time
+import threading
+import queue
+
+import cv2
+
+import frame_sampler
+from const import PIPELINE_QUEUE_SIZE, ANALYSIS_OPTIONS, PREVIEW_INTERVAL, PREVIEW_MAX_SIDE
+
+
+# ストリームの終端を表す番兵
+_END = object()
+# ステージ名(処理時間の記録に使う)
+STAGES = ["decode", "detect", "draw", "encode"]
+
+
+class PipelineStopped(Exception):
+    """パイプラインが途中で停止されたことを表す例外
+    """
+
+
+class AnalysisPipeline():
+    """解析パイプライン
+
+    デコード → 検出 → 描画 → エンコード の各ステージを別スレッドで実行し、
+    ステージ間を上限付きキューでつなぐ。
+    各ステージは1スレッドで先入れ先出しに処理するため、フレームの順序は保たれる。
+    画像は読み込んだ配列に直接描画する(描画用の画像を別に確保しない)。
+
+    metricsを指定すると、各ステージの1フレームあたりの処理時間
+    (キューの待ち時間は含まない)を metrics.add(ステージ名, 秒) で記録する。
+    ステージ名は STAGES のとおり。
+
+    previewを指定すると、preview_intervalフレームごとに描画画像を縮小して
+    preview(フレーム番号, 縮小画像) を呼ぶ(縮小画像は呼び出し側で保持してよい)。
+    """
+    def __init__(self, reader, detector, sink, options=None, queue_size=PIPELINE_QUEUE_SIZE, metrics=None,
+                 preview=None, preview_interval=PREVIEW_INTERVAL):
+        """コンストラクタ
+
+        Args:
+            reader (frame_reader.FrameReader): 動画の読み込みクラス
+            detector (hands_detector.HandsDetector): 手のひら検知
+            sink (result_writer.ChunkedResultWriter): 解析結果の書き込み先
+            options (dict or None): 解析の設定(ANALYSIS_OPTIONSと同じ形式)
+            queue_size (int): ステージ間キューの最大長
+            metrics (object or None): 処理時間の記録先(add(stage, seconds)を持つもの)
+            preview (function(int, ndarray) or None): プレビュー画像を受け取る関数
+            preview_interval (int): プレビュー画像を作るフレームの間隔(0の場合は作らない)
+        """
+        self.reader = reader
+        self.options = dict(ANALYSIS_OPTIONS, **(options or {}))
+        # フレームのタイムスタンプの計算に使う
+        self.fps = reader.fps
+        self.detector = detector
+        self.sink = sink
+        self.queue_size = queue_size
+        self.metrics = metrics
+        self.preview = preview
+        self.preview_interval = preview_interval
+        self._stop = threading.Event()
+        self._errors = []
+
+    def run(self, start_frame, nframe, callback=None):
+        """解析の実行
+
+        Args:
+            start_frame (int): 解析を開始するフレーム番号
+            nframe (int): フレーム数
+            callback (function(int, int) or None):
+                1フレームの処理が完了するたびに(フレーム番号, フレーム数)で呼ばれる関数
+
+        Returns:
+            なし
+
+        Raises:
+            いずれかのステージで発生した例外をそのまま送出する
+        """
+        q_decoded = queue.Queue(self.queue_size)
+        q_detected = queue.Queue(self.queue_size)
+        q_drawn = queue.Queue(self.queue_size)
+        q_encoded = queue.Queue(self.queue_size)
+        threads = [
+            threading.Thread(target=self._stage, args=(self._decode_frames(start_frame, nframe), q_decoded), daemon=True),
+            threading.Thread(target=self._stage, args=(self._detect_frames(q_decoded), q_detected), daemon=True),
+            threading.Thread(target=self._stage, args=(self._draw_frames(q_detected), q_drawn), daemon=True),
+            threading.Thread(target=self._stage, args=(self._encode_frames(q_drawn), q_encoded), daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for iframe in self._iter_queue(q_encoded):
+                if callback is not None:
+                    callback(iframe, nframe)
+        except PipelineStopped:
+            # いずれかのステージでエラーが発生した
+            pass
+        finally:
+            # 呼び出し側の例外(Streamlitの再実行など)でも各ステージを確実に止める
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+
+    def _decode_frames(self, start_frame, nframe):
+        """デコードステージ
+
+        Args:
+            start_frame (int): 解析を開始するフレーム番号
+            nframe (int): フレーム数
+
+        Yields:
+            tuple(int, ndarray): フレーム番号, RGB画像
+        """
+        frames = self.reader.frames(start_frame, nframe)
+        while True:
+            start = time.perf_counter()
+            item = next(frames, None)
+            if item is None:
+                return
+            self._record("decode", start)
+            yield item
+
+    def _detect_frames(self, q_in):
+        """検出ステージ
+
+        キーフレーム以外は推論せずに溜めておき、次のキーフレームを推論してから
+        前後のキーフレームの結果を補間して順番に出力する
+
+        Args:
+            q_in (queue.Queue): デコード済みフレームのキュー
+
+        Yields:
+            tuple(int, ndarray, tuple, bool): フレーム番号, RGB画像, 解析結果の配列, 補間したかどうか
+        """
+        # 前回の動画のトラッキング結果を引き継がない
+        self.detector.reset()
+        sampler = frame_sampler.FrameSampler(self.options["detect_interval"], self.options["adaptive"])
+        # 直前のキーフレーム(フレーム番号, 解析結果の配列)
+        keyframe = None
+        # 推論を省略したフレーム
+        pending = []
+        for iframe, image_rgb in self._iter_queue(q_in):
+            if sampler.is_keyframe(iframe) is False:
+                pending.append((iframe, image_rgb))
+                continue
+            hands = self._infer(iframe, image_rgb)
+            if pending:
+                yield from self._interpolate(keyframe, (iframe, hands), pending)
+            yield iframe, image_rgb, hands, False
+            sampler.update(iframe, hands)
+            keyframe = (iframe, hands)
+            pending = []
+
+        # 最後のフレームは補間できないため推論する
+        if pending:
+            iframe, image_rgb = pending.pop()
+            hands = self._infer(iframe, image_rgb)
+            yield from self._interpolate(keyframe, (iframe, hands), pending)
+            yield iframe, image_rgb, hands, False
+
+    def _infer(self, iframe, image_rgb):
+        """1フレームの推論
+
+        Args:
+            iframe (int): フレーム番号
+            image_rgb (ndarray): RGB画像
+
+        Returns:
+            tuple(ndarray, ndarray, ndarray): 解析結果の配列
+        """
+        start = time.perf_counter()
+        timestamp_ms = round(iframe * 1000 / self.fps)
+        detection_result = self.detector.infer(image_rgb, timestamp_ms)
+        hands = self.detector.to_arrays(detection_result)
+        self._record("detect", start)
+        return hands
+
+    def _interpolate(self, keyframe_a, keyframe_b, pending):
+        """推論を省略したフレームの補間
+
+        Args:
+            keyframe_a (tuple(int, tuple)): 前のキーフレームの(フレーム番号, 解析結果の配列)
+            keyframe_b (tuple(int, tuple)): 後のキーフレームの(フレーム番号, 解析結果の配列)
+            pending (list(tuple(int, ndarray))): 推論を省略したフレーム
+
+        Yields:
+            tuple(int, ndarray, tuple, bool): フレーム番号, RGB画像, 補間した解析結果の配列, True
+        """
+        iframe_a, hands_a = keyframe_a
+        iframe_b, hands_b = keyframe_b
+        for iframe, image_rgb in pending:
+            t = (iframe - iframe_a) / (iframe_b - iframe_a)
+            yield iframe, image_rgb, frame_sampler.interpolate(hands_a, hands_b, t), True
+
+    def _draw_frames(self, q_in):
+        """描画ステージ
+
+        Args:
+            q_in (queue.Queue): 検出済みフレームのキュー
+
+        Yields:
+            tuple(int, tuple, ndarray, bool):
+                フレーム番号, 解析結果の配列, 描画画像(RGB), 補間したかどうか
+        """
+        for iframe, image_rgb, hands, interpolated in self._iter_queue(q_in):
+            # 描画前の画像は使わないため、コピーせずに描画する
+            # (JSONへの変換は書き込み先が区間ごとにまとめて行う)
+            start = time.perf_counter()
+            drawn_image = self.detector.draw(image_rgb, hands, inplace=True)
+            self._record("draw", start)
+            yield iframe, hands, drawn_image, interpolated
+
+    def _encode_frames(self, q_in):
+        """エンコードステージ
+
+        Args:
+            q_in (queue.Queue): 描画済みフレームのキュー
+
+        Yields:
+            int: フレーム番号
+        """
+        for iframe, hands, drawn_image, interpolated in self._iter_queue(q_in):
+            start = time.perf_counter()
+            self.sink.write(iframe, hands, drawn_image, interpolated)
+            self._record("encode", start)
+            if self.preview is not None and self.preview_interval > 0 and iframe % self.preview_interval == 0:
+                self.preview(iframe, _thumbnail(drawn_image))
+            yield iframe
+
+    def _record(self, stage, start):
+        """処理時間の記録
+
+        Args:
+            stage (str): ステージ名
+            start (float): 処理を開始したときの time.perf_counter() の値
+        """
+        if self.metrics is not None:
+            self.metrics.add(stage, time.perf_counter() - start)
+
+    def _stage(self, items, q_out):
+        """ステージのスレッド本体
+
+        Args:
+            items (generator): ステージの出力を生成するジェネレーター
+            q_out (queue.Queue): 出力先のキュー
+        """
+        try:
+            for item in items:
+                self._put(q_out, item)
+        except PipelineStopped:
+            pass
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            # 後段のステージを終了させる
+            try:
+                self._put(q_out, _END)
+            except PipelineStopped:
+                pass
+
+    def _put(self, q, item):
+        """停止要求を確認しながらキューに積む
+
+        Args:
+            q (queue.Queue): キュー
+            item (object): 積む要素
+
+        Raises:
+            PipelineStopped: 停止要求があった場合
+        """
+        while True:
+            if self._stop.is_set() and item is not _END:
+                raise PipelineStopped()
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if self._stop.is_set():
+                    raise PipelineStopped()
+
+    def _iter_queue(self, q):
+        """番兵が来るまでキューから取り出す
+
+        Args:
+            q (queue.Queue): キュー
+
+        Yields:
+            object: キューの要素
+        """
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop.is_set():
+                    raise PipelineStopped()
+                continue
+            if item is _END:
+                return
+            yield item
+
+
+def _thumbnail(image_rgb, max_side=PREVIEW_MAX_SIDE):
+    """プレビュー用の縮小画像の作成
+
+    Args:
+        image_rgb (ndarray((height, width, 3), dtype=np.uint8)): RGB画像
+        max_side (int): 縮小後の長辺[pixel]
+
+    Returns:
+        ndarray((height, width, 3), dtype=np.uint8): 縮小したRGB画像(元の画像とはメモリを共有しない)
+    """
+    h, w = image_rgb.shape[:2]
+    scale = min(1.0, max_side / max(h, w))
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    return cv2.resize(image_rgb, size, interpolation=cv2.INTER_AREA)
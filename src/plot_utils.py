@@ -0,0 +1,81 @@
+import math
+
+import numpy as np
+
+
+def density_grid(xy, width, height, bins):
+    """2次元の密度分布の計算
+
+    座標をヒストグラムに集計し、ガウス関数で平滑化する(カーネル密度推定の近似)。
+    平滑化はFFTで行うため、点の数によらず計算量はビン数で決まる。
+    バンド幅はseabornのkdeと同じくScottの規則で決める。
+
+    Args:
+        xy (ndarray((点の数, 2))): ピクセル座標
+        width (int): 画像の幅
+        height (int): 画像の高さ
+        bins (int): 横方向のビン数(縦方向は縦横比から決める)
+
+    Returns:
+        ndarray((縦のビン数, 横のビン数), dtype=np.float64): 密度(合計が1)
+    """
+    nx = bins
+    ny = max(1, round(bins * height / width))
+    hist, _, _ = np.histogram2d(
+        xy[:, 1], xy[:, 0], bins=(ny, nx), range=((0, height), (0, width)))
+    if len(xy) < 2:
+        return hist / max(hist.sum(), 1.0)
+
+    # バンド幅(ビン単位)
+    sigma = np.std(xy, axis=0) * len(xy) ** (-1 / 6)
+    sigma_x = max(sigma[0] * nx / width, 0.5)
+    sigma_y = max(sigma[1] * ny / height, 0.5)
+
+    # 端で折り返さないように余白をつけてから平滑化する
+    pad_x = math.ceil(3 * sigma_x)
+    pad_y = math.ceil(3 * sigma_y)
+    padded = np.pad(hist, ((pad_y, pad_y), (pad_x, pad_x)))
+    fy = np.fft.fftfreq(padded.shape[0])[:, None]
+    fx = np.fft.rfftfreq(padded.shape[1])[None, :]
+    spectrum = np.fft.rfft2(padded)
+    spectrum *= np.exp(-2 * np.pi ** 2 * ((sigma_y * fy) ** 2 + (sigma_x * fx) ** 2))
+    smoothed = np.fft.irfft2(spectrum, s=padded.shape)[pad_y:pad_y + ny, pad_x:pad_x + nx]
+    smoothed = np.clip(smoothed, 0, None)
+    return smoothed / max(smoothed.sum(), np.finfo(np.float64).tiny)
+
+
+def lttb(xy, n_out):
+    """軌跡の間引き(Largest-Triangle-Three-Buckets)
+
+    点列を n_out 個の区間に分け、各区間から前後の点と作る三角形の面積が
+    最大になる点を選ぶ。曲がり角などの形状を保ったまま点の数を減らせる。
+
+    Args:
+        xy (ndarray((点の数, 2))): 座標(時系列順)
+        n_out (int): 間引き後の点の数
+
+    Returns:
+        ndarray((n_out, 2)): 間引き後の座標
+    """
+    n = len(xy)
+    if n_out >= n or n_out < 3:
+        return xy
+
+    # 最初と最後の点を除いた点を n_out - 2 個の区間に分ける
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    out = np.empty((n_out, 2), dtype=np.float64)
+    out[0] = xy[0]
+    out[-1] = xy[-1]
+    a = xy[0]
+    for i in range(n_out - 2):
+        bucket = xy[edges[i]:edges[i + 1]]
+        # 次の区間の平均(最後の区間の次は最後の点)
+        if i + 2 < len(edges):
+            c = xy[edges[i + 1]:edges[i + 2]].mean(axis=0)
+        else:
+            c = xy[-1]
+        area = np.abs(
+            (a[0] - c[0]) * (bucket[:, 1] - a[1]) - (a[0] - bucket[:, 0]) * (c[1] - a[1]))
+        a = bucket[area.argmax()]
+        out[i + 1] = a
+    return out
@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import threading
+import contextlib
+
+import result_writer
+import landmark_store
+from const import CACHE_DIR, CACHE_MAX_BYTES
+
+
+# キャッシュする解析結果のファイル
+RESULT_FILES = ["result.json"] + [
+    landmark_store.STORE_DIR + "/" + name for name in landmark_store.STORE_FILES
+]
+# キャッシュする解析結果のファイルのうち、解析の設定によっては作成されないもの
+OPTIONAL_FILES = ["result.mp4"]
+# キャッシュの管理情報のファイル名
+INDEX_FILE = "index.json"
+# 同じ保存先を使うプロセス間(画面とコマンドラインなど)で排他するためのファイル名
+LOCK_FILE = ".lock"
+
+
+class ResultCache():
+    """解析結果のキャッシュ
+
+    動画ファイルの内容とAIモデルの設定から求めたハッシュ値をキーとして解析結果を保存し、
+    同じ動画を再度解析するときは保存済みの結果を返す。
+    容量が上限を超えた場合は、最後に使われたのが古いものから削除する。
+    同じ保存先を複数のプロセスで使えるように、操作のたびにファイルロックを獲得して管理情報を読み直す。
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        """コンストラクタ
+
+        Args:
+            cache_dir (str): キャッシュの保存先
+            max_bytes (int): キャッシュの容量の上限[byte]
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = {}
+
+    def key(self, video_sha256, options):
+        """キャッシュのキーの計算
+
+        Args:
+            video_sha256 (str): 動画ファイルのハッシュ値(media_index.video_sha256で取得したもの)
+            options (dict): 解析結果に影響する設定
+
+        Returns:
+            str: キー(SHA-256の16進数)
+        """
+        sha256 = hashlib.sha256()
+        sha256.update(video_sha256.encode())
+        sha256.update(json.dumps(options, sort_keys=True).encode())
+        return sha256.hexdigest()
+
+    def lookup(self, key, outdir):
+        """キャッシュの検索
+
+        見つかった場合は、解析結果を出力先フォルダにリンクする。
+        以前に中断した解析の途中ファイルは削除する(再開するとリンクしたキャッシュに書き込んでしまうため)
+
+        Args:
+            key (str): キャッシュのキー
+            outdir (str): 解析結果の出力先フォルダ
+
+        Returns:
+            bool: 見つかったかどうか
+        """
+        with self._locked():
+            if key not in self._index:
+                return False
+            os.makedirs(outdir, exist_ok=True)
+            for name in RESULT_FILES:
+                _link(self.cache_dir + key + "/" + name, outdir + "/" + name)
+            for name in OPTIONAL_FILES:
+                if os.path.exists(self.cache_dir + key + "/" + name):
+                    _link(self.cache_dir + key + "/" + name, outdir + "/" + name)
+                elif os.path.exists(outdir + "/" + name):
+                    # 以前の解析結果のファイルは残さない
+                    os.remove(outdir + "/" + name)
+            if os.path.exists(outdir + "/" + result_writer.CHECKPOINT_FILE):
+                os.remove(outdir + "/" + result_writer.CHECKPOINT_FILE)
+            shutil.rmtree(outdir + "/" + result_writer.CHUNK_DIR, ignore_errors=True)
+            self._index[key]["last_used"] = time.time()
+            self._save_index()
+            return True
+
+    def store(self, key, outdir):
+        """解析結果をキャッシュに保存する
+
+        ファイルはハードリンクで共有するため、解析結果と二重に容量を消費しない
+
+        Args:
+            key (str): キャッシュのキー
+            outdir (str): 解析結果の出力先フォルダ
+
+        Returns:
+            なし
+        """
+        with self._locked():
+            entry_dir = self.cache_dir + key
+            os.makedirs(entry_dir, exist_ok=True)
+            size = 0
+            for name in RESULT_FILES + OPTIONAL_FILES:
+                if name in OPTIONAL_FILES and os.path.exists(outdir + "/" + name) is False:
+                    continue
+                _link(outdir + "/" + name, entry_dir + "/" + name)
+                size += os.path.getsize(entry_dir + "/" + name)
+            self._index[key] = {
+                "size": size,
+                "last_used": time.time(),
+            }
+            self._evict()
+            self._save_index()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """キャッシュの排他
+
+        スレッド間に加えて、ファイルロックで他のプロセスとも排他し、
+        他のプロセスが更新した管理情報を読み直す
+
+        Yields:
+            なし
+        """
+        with self._lock:
+            with open(self.cache_dir + LOCK_FILE, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    self._index = self._load_index()
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _evict(self):
+        """容量が上限を超えていれば、最後に使われたのが古いものから削除する
+
+        管理情報にない保存結果(他のプロセスに管理情報を上書きされたものなど)も削除する
+        """
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir() and entry.name not in self._index:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        total = sum(entry["size"] for entry in self._index.values())
+        for key in sorted(self._index, key=lambda key: self._index[key]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= self._index.pop(key)["size"]
+            shutil.rmtree(self.cache_dir + key, ignore_errors=True)
+
+    def _load_index(self):
+        """管理情報の読み込み
+
+        Returns:
+            dict: キー => {"size": 容量, "last_used": 最終使用時刻}
+        """
+        filename = self.cache_dir + INDEX_FILE
+        if os.path.exists(filename) is False:
+            return {}
+        with open(filename) as f:
+            index = json.load(f)
+        # ファイルが消されたものは除く
+        return {
+            key: entry for key, entry in index.items()
+            if all(os.path.exists(self.cache_dir + key + "/" + name) for name in RESULT_FILES)
+        }
+
+    def _save_index(self):
+        """管理情報の保存
+        """
+        result_writer.write_json_atomic(self.cache_dir + INDEX_FILE, self._index)
+
+
+def file_sha256(filename):
+    """ファイルのハッシュ値
+
+    Args:
+        filename (str): ファイル名
+
+    Returns:
+        str: SHA-256(16進数)
+    """
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _link(src, dst):
+    """ファイルをハードリンクする
+
+    ハードリンクできない場合(ファイルシステムが異なる場合など)はコピーする
+
+    Args:
+        src (str): リンク元
+        dst (str): リンク先
+    """
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
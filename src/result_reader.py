@@ -0,0 +1,150 @@
+import os
+import json
+
+import numpy as np
+
+import landmark_store
+
+
+# result.json を読み込むときの1回の読み込みサイズ[文字]
+READ_SIZE = 1024 * 1024
+
+
+def read_landmarks(outdir, keys, start=0, stop=None, step=1):
+    """指定した関節点の座標を読み込む
+
+    配列形式の解析結果があればメモリマップで必要な部分だけを読み込み、
+    なければ result.json を先頭から少しずつ読み込む。
+    いずれの場合も、解析結果全体をメモリに展開しない。
+
+    Args:
+        outdir (str): 解析結果フォルダ
+        keys (list(str)): 関節点の名前(LANDMARK_LABELS)
+        start (int): 読み込む最初のフレーム番号
+        stop (int or None): 読み込む最後のフレーム番号+1(Noneの場合は最後まで)
+        step (int): 読み込むフレームの間隔
+
+    Returns:
+        dict: 左右の名前 => 関節点の名前 => ndarray((点の数, 2), dtype=np.float64) ピクセル座標
+    """
+    if landmark_store.has_store(outdir):
+        return _read_store(outdir, keys, start, stop, step)
+    return _read_json(outdir + "/result.json", keys, start, stop, step)
+
+
+def result_mtime(outdir):
+    """解析結果の更新時刻
+
+    読み込み結果をキャッシュするときに、解析結果が更新されたことを検知するために使う
+
+    Args:
+        outdir (str): 解析結果フォルダ
+
+    Returns:
+        float: 解析結果のファイルのうち、最も新しい更新時刻
+    """
+    list_files = [
+        outdir + "/result.json",
+        outdir + "/" + landmark_store.STORE_DIR + "/" + landmark_store.META_FILE,
+    ]
+    return max([os.path.getmtime(f) for f in list_files if os.path.exists(f)], default=0.0)
+
+
+def iter_json_array(f, read_size=READ_SIZE):
+    """JSONの配列の要素を1つずつ読み込む
+
+    Args:
+        f (file): JSONの配列が書かれたファイル
+        read_size (int): 1回の読み込みサイズ[文字]
+
+    Yields:
+        object: 配列の要素
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(read_size).lstrip()
+    if buffer.startswith("[") is False:
+        raise ValueError("JSONの配列ではありません")
+    pos = 1
+    eof = False
+    while True:
+        # 要素の区切りと空白を読み飛ばす
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer):
+            if buffer[pos] == "]":
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # 要素が読み込み済みの範囲で終わっていない
+                if eof:
+                    raise
+            else:
+                yield item
+                continue
+        elif eof:
+            raise ValueError("JSONの配列が閉じていません")
+        # 読み込み済みの部分を捨てて続きを読む
+        chunk = f.read(read_size)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        eof = len(chunk) == 0
+
+
+def _read_store(outdir, keys, start, stop, step):
+    """配列形式の解析結果から関節点の座標を読み込む
+
+    Args:
+        outdir (str): 解析結果フォルダ
+        keys (list(str)): 関節点の名前
+        start (int): 読み込む最初のフレーム番号
+        stop (int or None): 読み込む最後のフレーム番号+1
+        step (int): 読み込むフレームの間隔
+
+    Returns:
+        dict: 左右の名前 => 関節点の名前 => ndarray((点の数, 2), dtype=np.float64)
+    """
+    store = landmark_store.LandmarkStore(outdir)
+    handedness = np.asarray(store.handedness[start:stop:step])
+    key_indices = [landmark_store.LANDMARK_LABELS.index(key) for key in keys]
+    dict_data = {}
+    for label_index, label in enumerate(landmark_store.HANDEDNESS_LABELS):
+        # (フレーム, 手)の順に並んだ該当する手
+        iframe, ihand = np.nonzero(handedness == label_index)
+        coordinates = store.coordinates[start:stop:step][iframe, ihand][:, key_indices, :2]
+        coordinates = coordinates.astype(np.float64) * store.size
+        dict_data[label] = {key: coordinates[:, i] for i, key in enumerate(keys)}
+    return dict_data
+
+
+def _read_json(filename, keys, start, stop, step):
+    """result.json から関節点の座標を読み込む
+
+    Args:
+        filename (str): 結果ファイルのパス
+        keys (list(str)): 関節点の名前
+        start (int): 読み込む最初のフレーム番号
+        stop (int or None): 読み込む最後のフレーム番号+1
+        step (int): 読み込むフレームの間隔
+
+    Returns:
+        dict: 左右の名前 => 関節点の名前 => ndarray((点の数, 2), dtype=np.float64)
+    """
+    dict_list = {
+        label: {key: [] for key in keys}
+        for label in landmark_store.HANDEDNESS_LABELS
+    }
+    with open(filename) as f:
+        for results in iter_json_array(f):
+            iframe = results["FrameNumber"]
+            if stop is not None and iframe >= stop:
+                break
+            if iframe < start or (iframe - start) % step != 0:
+                continue
+            for result in results["Results"]:
+                for key in keys:
+                    dict_list[result["CategoryName"]][key].append(result["Coordinates"][key])
+    return {
+        label: {key: np.array(xy, dtype=np.float64).reshape(-1, 2) for key, xy in dict_key.items()}
+        for label, dict_key in dict_list.items()
+    }
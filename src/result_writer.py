@@ -0,0 +1,456 @@
+import os
+import glob
+import json
+import queue
+import shutil
+import threading
+
+import video_writer
+import landmark_store
+from const import CHUNK_FRAMES, ANALYSIS_OPTIONS, VIDEO_ENCODE_PRESETS, VIDEO_ENCODE_THREADS
+
+
+# 区間ごとの途中結果を保存するフォルダ名
+CHUNK_DIR = "chunks"
+# 解析の進み具合を記録するファイル名
+CHECKPOINT_FILE = "checkpoint.json"
+
+# JSONの書き込みスレッドの終了を表す番兵
+_END = object()
+
+
+class SegmentWriter():
+    """区間ごとの途中ファイルの書き込みクラス
+
+    解析結果をフレーム区間ごとの途中ファイル(JSONと動画)と配列形式の解析結果に書き込む。
+    区間が完了するたびに on_chunk_done を区間の先頭フレーム番号で呼ぶ。
+    チェックポイントは更新しないため、複数のプロセスで別々の区間を並行して書き込める。
+
+    フレームごとには配列形式の解析結果にのみ書き込む。
+    JSONへの変換は区間が終わったときに、配列形式の解析結果から区間分をまとめて
+    別スレッドで行うため、解析の処理を待たせない。
+    JSONの書き込みスレッドで発生した例外は、次のwriteまたはcloseで送出する。
+    """
+    def __init__(self, outdir, store, fps, shape, encode, chunk_size, on_chunk_done=None, metrics=None):
+        """コンストラクタ
+
+        Args:
+            outdir (str): 解析結果の出力先フォルダ
+            store (landmark_store.LandmarkStoreWriter): 配列形式の解析結果の書き込み先
+            fps (float): フレームレート
+            shape (tuple(int, int)): (幅, 高さ)
+            encode (dict or None): 出力動画のエンコード設定(Noneの場合は動画を作成しない)
+            chunk_size (int): 1区間のフレーム数
+            on_chunk_done (function(int) or None): 区間が完了したときに呼ばれる関数
+            metrics (object or None): 動画のエンコード時間の記録先(VideoWriterを参照)
+        """
+        self.chunk_dir = outdir + "/" + CHUNK_DIR
+        self.store = store
+        self.fps = fps
+        self.shape = shape
+        self.encode = encode
+        self.chunk_size = chunk_size
+        self.on_chunk_done = on_chunk_done
+        self.metrics = metrics
+        # 書き込み中の区間
+        self._chunk_start = None
+        self._chunk_stop = None
+        self._writer = None
+        # JSONの書き込みスレッド
+        self._error = None
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def write(self, iframe, hands, image_rgb, interpolated=False):
+        """1フレーム分の結果の書き込み
+
+        Args:
+            iframe (int): フレーム番号
+            hands (tuple(ndarray, ndarray, ndarray)):
+                HandsDetector.to_arraysで変換した解析結果
+            image_rgb (ndarray((height, width, 3), dtype=np.uint8)):
+                描画画像(RGB)
+            interpolated (bool): 前後のフレームから補間した結果かどうか
+
+        Returns:
+            なし
+
+        Raises:
+            JSONの書き込みスレッドで発生した例外
+        """
+        self._raise_error()
+        if self._chunk_start is None:
+            self._open_chunk(iframe - iframe % self.chunk_size)
+        if self._writer is not None:
+            self._writer.write(image_rgb)
+        self.store.write(iframe, hands, interpolated)
+        self._chunk_stop = iframe + 1
+        if iframe + 1 - self._chunk_start == self.chunk_size:
+            self._close_chunk()
+
+    def close(self):
+        """書き込み中の区間を完了させる
+
+        動画の最後の区間など、区間の長さに満たないまま終わった区間を確定させ、
+        JSONの書き込みが終わるまで待つ
+
+        Returns:
+            なし
+
+        Raises:
+            JSONの書き込みスレッドで発生した例外
+        """
+        if self._chunk_start is not None:
+            self._close_chunk()
+        self._join()
+        self._raise_error()
+
+    def abort(self):
+        """書き込み中の区間の破棄
+
+        JSONの書き込みを待っている区間は、書き込んでから終了する
+
+        Returns:
+            なし
+        """
+        if self._writer is not None:
+            try:
+                self._writer.release()
+            except Exception:
+                # 破棄するファイルのエンコードエラーは無視する
+                pass
+            self._writer = None
+            os.remove(chunk_path(self.chunk_dir, self._chunk_start) + ".part.mp4")
+        self._chunk_start = None
+        self._join()
+
+    def _open_chunk(self, start):
+        """区間の書き込み開始
+
+        Args:
+            start (int): 区間の先頭フレーム番号
+        """
+        self._chunk_start = start
+        self._chunk_stop = start
+        if self.encode is not None:
+            self._writer = video_writer.VideoWriter(
+                chunk_path(self.chunk_dir, start) + ".part.mp4", self.encode["codec"], self.fps, self.shape,
+                preset=self.encode["preset"], crf=self.encode["crf"], threads=VIDEO_ENCODE_THREADS,
+                background=True, metrics=self.metrics)
+
+    def _close_chunk(self):
+        """区間の書き込み完了
+
+        動画を確定させ、JSONの書き込みを書き込みスレッドに依頼する
+        """
+        start = self._chunk_start
+        if self._writer is not None:
+            path = chunk_path(self.chunk_dir, start)
+            self._writer.release()
+            self._writer = None
+            os.replace(path + ".part.mp4", path + ".mp4")
+        self._chunk_start = None
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._json_loop, daemon=True)
+            self._thread.start()
+        self._queue.put((start, self._chunk_stop))
+
+    def _json_loop(self):
+        """JSONの書き込みスレッド本体
+
+        配列形式の解析結果をディスクに反映してから区間のJSONを書き込み、
+        途中ファイルがそろったら on_chunk_done を呼ぶ
+        """
+        while True:
+            item = self._queue.get()
+            if item is _END:
+                return
+            if self._error is not None:
+                # エラー後は書き込まずに読み捨てる(完了していない区間は次回やり直す)
+                continue
+            start, stop = item
+            try:
+                self.store.flush()
+                write_json_atomic(chunk_path(self.chunk_dir, start) + ".json", self.store.to_json(start, stop))
+                if self.on_chunk_done is not None:
+                    self.on_chunk_done(start)
+            except Exception as e:
+                self._error = e
+
+    def _join(self):
+        """JSONの書き込みスレッドの終了を待つ
+        """
+        if self._thread is not None:
+            self._queue.put(_END)
+            self._thread.join()
+            self._thread = None
+
+    def _raise_error(self):
+        """JSONの書き込みスレッドで発生した例外の送出
+        """
+        if self._error is not None:
+            raise self._error
+
+
+class ChunkedResultWriter():
+    """区間ごとに解析結果を書き込むクラス
+
+    解析結果をフレーム区間ごとの途中ファイル(JSONと動画)に書き出し、
+    区間が完了するたびにチェックポイントを更新する。
+    解析が途中で中断されても、同じ動画を再度解析すると
+    完了していない区間から再開できる。
+    すべての区間が完了したら、途中ファイルを連結して
+    result.json と result.mp4 を作成する。
+    解析の設定で動画を作成しないようにした場合は、result.mp4 は作成しない。
+
+    複数のプロセスで並行して解析する場合は、各プロセスが SegmentWriter で
+    別々の区間を書き込み、このクラスは完了した区間の記録と連結のみを行う。
+    """
+    def __init__(self, outdir, video_path, nframe, fps, shape, num_hands, options=None,
+                 detector_options=None, chunk_size=CHUNK_FRAMES, metrics=None):
+        """コンストラクタ
+
+        Args:
+            outdir (str): 解析結果の出力先フォルダ
+            video_path (str): 解析する動画ファイルのパス
+            nframe (int): フレーム数
+            fps (float): フレームレート
+            shape (tuple(int, int)): (幅, 高さ)
+            num_hands (int): 1フレームあたりの手の最大数
+            options (dict or None): 解析の設定(ANALYSIS_OPTIONSと同じ形式。設定が異なる途中結果からは再開しない)
+            detector_options (dict or None): AIモデルの設定(HandsDetector.options。設定が異なる途中結果からは再開しない)
+            chunk_size (int): 1区間のフレーム数
+            metrics (object or None): 動画のエンコード時間の記録先(VideoWriterを参照)
+        """
+        self.outdir = outdir
+        self.chunk_dir = outdir + "/" + CHUNK_DIR
+        self.nframe = nframe
+        options = dict(ANALYSIS_OPTIONS, **(options or {}))
+        # 出力動画のエンコード設定(Noneの場合は動画を作成しない)
+        self.encode = VIDEO_ENCODE_PRESETS[options["video"]] if options["video"] else None
+        # 推論サイズ・推論モード・モデルファイルなどが異なる途中結果と混ざらないように、AIモデルの設定も比較する
+        self.checkpoint = self._load_checkpoint(
+            video_path, nframe, dict(detector_options or {}, **options), chunk_size)
+        self.chunk_size = self.checkpoint["chunk_size"]
+        # 配列形式の解析結果は区間に分けず、1つのファイルに直接書き込む
+        self.store = landmark_store.LandmarkStoreWriter(
+            outdir, nframe, num_hands, shape,
+            resume=len(self.checkpoint["completed_chunks"]) > 0)
+        self.segment = SegmentWriter(
+            outdir, self.store, fps, shape, self.encode, self.chunk_size, self.complete_chunk, metrics)
+
+    def write(self, iframe, hands, image_rgb, interpolated=False):
+        """1フレーム分の結果の書き込み
+
+        Args:
+            SegmentWriter.writeと同じ
+
+        Returns:
+            なし
+        """
+        self.segment.write(iframe, hands, image_rgb, interpolated)
+
+    def pending_ranges(self, nsegments):
+        """未完了の区間を、並行して解析するためにほぼ同じ数ずつに分ける
+
+        Args:
+            nsegments (int): 分割数
+
+        Returns:
+            list(list(tuple(int, int))):
+                分割ごとの(最初のフレーム番号, 最後のフレーム番号+1)のリスト(連続した区間はまとめる)
+        """
+        completed = set(self.checkpoint["completed_chunks"])
+        pending = [
+            start for start in range(0, self.nframe, self.chunk_size)
+            if start not in completed
+        ]
+        nsegments = max(1, min(nsegments, len(pending)))
+        list_ranges = []
+        for isegment in range(nsegments):
+            ranges = []
+            for start in pending[len(pending) * isegment // nsegments:len(pending) * (isegment + 1) // nsegments]:
+                stop = min(start + self.chunk_size, self.nframe)
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1] = (ranges[-1][0], stop)
+                else:
+                    ranges.append((start, stop))
+            if ranges:
+                list_ranges.append(ranges)
+        return list_ranges
+
+    def complete_chunk(self, start):
+        """区間の完了をチェックポイントに記録する
+
+        Args:
+            start (int): 区間の先頭フレーム番号
+
+        Returns:
+            なし
+        """
+        completed = self.checkpoint["completed_chunks"]
+        # 記録済みの区間を重ねて記録すると、連結したときに重複する
+        if start in completed:
+            return
+        completed.append(start)
+        completed.sort()
+        # 先頭から連続して完了している最後のフレーム
+        last_completed_frame = -1
+        for start in completed:
+            if start != last_completed_frame + 1:
+                break
+            last_completed_frame = min(start + self.chunk_size, self.nframe) - 1
+        self.checkpoint["last_completed_frame"] = last_completed_frame
+        write_json_atomic(self.outdir + "/" + CHECKPOINT_FILE, self.checkpoint)
+
+    def finish(self):
+        """解析結果の作成
+
+        書き込み中の区間を完了させ、すべての区間を連結して
+        result.json と result.mp4 を作成する。途中ファイルは削除する。
+        配列形式の解析結果はメタ情報を確定させる。
+
+        Returns:
+            なし
+        """
+        self.segment.close()
+        list_chunks = [
+            chunk_path(self.chunk_dir, start)
+            for start in sorted(self.checkpoint["completed_chunks"])
+        ]
+        _concat_json([path + ".json" for path in list_chunks], self.outdir + "/result.json")
+        if self.encode is None:
+            # 以前の解析で作成した動画は残さない
+            if os.path.exists(self.outdir + "/result.mp4"):
+                os.remove(self.outdir + "/result.mp4")
+        elif len(list_chunks) > 0:
+            # 既存の result.mp4 はキャッシュとハードリンクで共有されている場合があるため、
+            # 上書きせずに置き換える
+            video_writer.concat_videos([path + ".mp4" for path in list_chunks], self.outdir + "/result.part.mp4")
+            os.replace(self.outdir + "/result.part.mp4", self.outdir + "/result.mp4")
+        self.store.close(self.checkpoint["last_completed_frame"] + 1)
+        shutil.rmtree(self.chunk_dir)
+        os.remove(self.outdir + "/" + CHECKPOINT_FILE)
+
+    def abort(self):
+        """書き込み中の区間の破棄
+
+        完了した区間とチェックポイントは残すため、次回はその続きから再開できる
+
+        Returns:
+            なし
+        """
+        self.segment.abort()
+
+    def _store_is_shared(self):
+        """配列形式の解析結果が他のファイルとハードリンクで共有されているかどうか
+
+        Returns:
+            bool: いずれかのファイルが共有されているかどうか
+        """
+        for name in landmark_store.STORE_FILES:
+            filename = self.outdir + "/" + landmark_store.STORE_DIR + "/" + name
+            if os.path.exists(filename) and os.stat(filename).st_nlink > 1:
+                return True
+        return False
+
+    def _load_checkpoint(self, video_path, nframe, options, chunk_size):
+        """チェックポイントの読み込み
+
+        チェックポイントが別の動画・別の設定のものである場合や、
+        配列形式の解析結果がキャッシュとハードリンクで共有されている場合(続きを書くとキャッシュを書き換えてしまう)は、
+        途中ファイルを削除して最初からやり直す
+
+        Args:
+            video_path (str): 解析する動画ファイルのパス
+            nframe (int): フレーム数
+            options (dict): 解析の設定とAIモデルの設定
+            chunk_size (int): 1区間のフレーム数
+
+        Returns:
+            dict: チェックポイント
+        """
+        stat = os.stat(video_path)
+        source = {
+            "path": os.path.basename(video_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+        }
+        filename = self.outdir + "/" + CHECKPOINT_FILE
+        if os.path.exists(filename):
+            with open(filename) as f:
+                checkpoint = json.load(f)
+            if checkpoint["source"] == source and checkpoint["nframe"] == nframe \
+                    and checkpoint.get("options", {}) == options and self._store_is_shared() is False:
+                # 前回中断した書き込み中のファイルは消す
+                for part in glob.glob(self.chunk_dir + "/*.part.mp4"):
+                    os.remove(part)
+                return checkpoint
+
+        if os.path.exists(self.chunk_dir):
+            shutil.rmtree(self.chunk_dir)
+        os.makedirs(self.chunk_dir)
+        checkpoint = {
+            "source": source,
+            "nframe": nframe,
+            "options": options,
+            "chunk_size": chunk_size,
+            "completed_chunks": [],
+            "last_completed_frame": -1,
+        }
+        write_json_atomic(filename, checkpoint)
+        return checkpoint
+
+
+def chunk_path(chunk_dir, start):
+    """区間の途中ファイルのパス(拡張子なし)
+
+    Args:
+        chunk_dir (str): 途中結果を保存するフォルダ
+        start (int): 区間の先頭フレーム番号
+
+    Returns:
+        str: ファイルパス
+    """
+    return "%s/%08d" % (chunk_dir, start)
+
+
+def _concat_json(list_filenames, filename):
+    """区間ごとのJSON(フレームの配列)を1つの配列に連結する
+
+    全区間をメモリに読み込まないよう、1区間ずつ書き出す
+
+    Args:
+        list_filenames (list(str)): 連結するJSONファイル名(連結順)
+        filename (str): 出力するJSONファイル名
+    """
+    with open(filename + ".tmp", "w") as fout:
+        fout.write("[")
+        first = True
+        for src in list_filenames:
+            with open(src) as fin:
+                body = fin.read().strip()[1:-1].strip()
+            if len(body) == 0:
+                continue
+            if first is False:
+                fout.write(", ")
+            fout.write(body)
+            first = False
+        fout.write("]")
+    os.replace(filename + ".tmp", filename)
+
+
+def write_json_atomic(filename, data):
+    """JSONファイルを書き込む
+
+    中断されても書き込み途中のファイルが残らないように、
+    一時ファイルに書いてから置き換える
+
+    Args:
+        filename (str): ファイル名
+        data (object): 書き込むデータ
+    """
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, filename)
@@ -0,0 +1,30 @@
+import streamlit as st
+
+import detector_pool
+import job_manager
+import download_server
+from const import DOWNLOAD_PORT, NUM_DETECTORS
+
+
+# st.cache_resourceの戻り値はユーザー間で共有される
+# => AIモデルのプールは全ユーザーで共有される
+@st.cache_resource
+def load_model():
+    AI = detector_pool.DetectorPool(NUM_DETECTORS)
+    return AI
+
+
+# 解析ジョブはサーバー上で1つの管理クラスが実行する
+# (前回の起動時に完了しなかったジョブを再開するため、どのページを開いても起動する)
+@st.cache_resource
+def load_job_manager():
+    JM = job_manager.JobManager(load_model())
+    return JM
+
+
+# ダウンロード用サーバーは全ユーザーで1つだけ起動する
+# (処理速度の取得(/metrics)にも使うため、どのページを開いても起動する)
+@st.cache_resource
+def load_download_server():
+    server = download_server.DownloadServer(DOWNLOAD_PORT)
+    return server
@@ -0,0 +1,103 @@
+import os
+import hashlib
+import tempfile
+import threading
+
+import media_index
+from const import UPLOAD_DIR, UPLOAD_CHUNK_BYTES, UPLOAD_MAX_BYTES
+
+
+# 書き込み途中の一時ファイルの接頭辞
+# (.から始まるファイルは動画の一覧に表示されない)
+PART_PREFIX = ".upload-"
+
+# 同じ名前・同じ内容のファイルの確認から保存までを排他する
+_lock = threading.Lock()
+
+
+class UploadTooLargeError(Exception):
+    """アップロードされたファイルが上限より大きいことを表す例外
+    """
+
+
+def save_upload(fileobj, name, upload_dir=UPLOAD_DIR, max_bytes=UPLOAD_MAX_BYTES, chunk_size=UPLOAD_CHUNK_BYTES):
+    """アップロードされたファイルの保存
+
+    一時ファイルに一定サイズずつ書き込みながらハッシュ値を計算し、
+    書き込みが終わったら保存先に置き換える(書き込み途中のファイルは見えない)。
+    同じ名前で同じ内容のファイルが保存済みの場合は書き込まない。
+    別の名前で同じ内容のファイルが保存済みの場合はハードリンクする。
+    既存のファイルを書き換えないため、解析の途中結果やキャッシュが無効にならない。
+    保存した動画は、ハッシュ値とともに動画の索引に登録する。
+
+    Args:
+        fileobj (file-like object): アップロードされたファイル(readで読み込めるもの)
+        name (str): 保存するファイル名
+        upload_dir (str): 保存先フォルダ
+        max_bytes (int): ファイルサイズの上限[byte]
+        chunk_size (int): 1回に書き込むサイズ[byte]
+
+    Returns:
+        str: ファイルのハッシュ値(SHA-256の16進数)
+        bool: ファイルを新しく保存したかどうか(保存済みの場合はFalse)
+
+    Raises:
+        UploadTooLargeError: ファイルサイズが上限を超えている場合
+    """
+    size = getattr(fileobj, "size", None)
+    if size is not None and size > max_bytes:
+        raise UploadTooLargeError(size)
+
+    # 画面の再実行で前回の読み込み位置が残っている場合がある
+    if hasattr(fileobj, "seek"):
+        fileobj.seek(0)
+
+    os.makedirs(upload_dir, exist_ok=True)
+    dst = upload_dir + name
+    fd, tmp = tempfile.mkstemp(prefix=PART_PREFIX, suffix=".part", dir=upload_dir)
+    try:
+        sha256 = hashlib.sha256()
+        nbytes = 0
+        with os.fdopen(fd, "wb") as f:
+            for block in iter(lambda: fileobj.read(chunk_size), b""):
+                nbytes += len(block)
+                if nbytes > max_bytes:
+                    raise UploadTooLargeError(nbytes)
+                sha256.update(block)
+                f.write(block)
+        digest = sha256.hexdigest()
+
+        with _lock:
+            index = media_index.load_index(upload_dir)
+            if index.get(name, {}).get("sha256") == digest and os.path.exists(dst):
+                return digest, False
+            # 同じ内容のファイルが別の名前で保存されていれば、そのファイルを共有する
+            same = [
+                other for other, entry in index.items()
+                if entry.get("sha256") == digest and other != name and os.path.exists(upload_dir + other)
+            ]
+            if same:
+                _link_or_replace(upload_dir + same[0], tmp)
+            os.replace(tmp, dst)
+            media_index.register_video(name, digest, upload_dir)
+        return digest, True
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _link_or_replace(src, tmp):
+    """一時ファイルを既存のファイルへのハードリンクに置き換える
+
+    ハードリンクできない場合(ファイルシステムが異なる場合など)は一時ファイルをそのまま使う
+
+    Args:
+        src (str): 既存のファイル
+        tmp (str): 一時ファイル
+    """
+    link = tmp + ".link"
+    try:
+        os.link(src, link)
+    except OSError:
+        return
+    os.replace(link, tmp)
@@ -1,10 +1,38 @@
+import time
+import queue
+import threading
+from fractions import Fraction
+
 import av
 
+from const import PIPELINE_QUEUE_SIZE
+
+
+# エンコードスレッドの終了を表す番兵
+_END = object()
+# 処理時間を記録するときのステージ名
+STAGE = "video_encode"
+
 
 class VideoWriter():
     """動画作成クラス
+
+    入力画像の形式(input_format)はRGBのほかBGR・YUVも指定でき、
+    エンコード時にyuv420pへの変換を1回だけ行う(yuv420pの場合は変換しない)。
+
+    backgroundをTrueにすると、エンコードと書き込みを別スレッドで行う。
+    writeは画像をフレームにコピーして上限付きキューに積むだけで戻るため、
+    呼び出し側はエンコードを待たない(キューが一杯の場合のみ待つ)。
+    エンコードスレッドで発生した例外は、次のwriteまたはreleaseで送出する。
+
+    with文で使うと、ブロックを抜けたときに確実にファイルを閉じる。
+
+    metricsを指定すると、1フレームのエンコードと書き込みの時間を
+    metrics.add(STAGE, 秒) で記録する。
     """
-    def __init__(self, filename, codec, fps, shape, bit_rate=5000000):
+    def __init__(self, filename, codec, fps, shape, bit_rate=5000000, input_format="rgb24",
+                 preset=None, crf=None, threads=0, thread_type="AUTO",
+                 background=False, queue_size=PIPELINE_QUEUE_SIZE, metrics=None):
         """コンストラクタ
 
         Args:
@@ -12,39 +40,182 @@ class VideoWriter():
             codec (str): コーデック (h264 or hevc)
             fps (float): フレームレート
             shape (tuple(int, int)): (幅, 高さ)
-            bit_rate (int): ビットレート
+            bit_rate (int): ビットレート(crfを指定した場合は使わない)
+            input_format (str): 入力画像の形式 (rgb24, bgr24 or yuv420p)
+            preset (str or None): エンコードの速度と圧縮率のプリセット
+                (ultrafast, superfast, veryfast, faster, fast, medium など。Noneの場合はエンコーダーの既定値)
+            crf (int or None): 品質を一定にする場合の品質(小さいほど高画質。Noneの場合はビットレートを一定にする)
+            threads (int): エンコードのスレッド数(0の場合は自動)
+            thread_type (str): スレッドの分割方法 (FRAME, SLICE or AUTO)
+            background (bool): エンコードを別スレッドで行うかどうか
+            queue_size (int): エンコード待ちのフレーム数の上限(backgroundの場合のみ)
+            metrics (object or None): 処理時間の記録先(add(stage, seconds)を持つもの)
         """
+        self.input_format = input_format
+        self.metrics = metrics
         self.writer = av.open(filename, "w")
         self.stream = self.writer.add_stream(codec, str(fps))
-        self.stream.bit_rate = bit_rate
         self.stream.pix_fmt = "yuv420p"
         self.stream.width = shape[0]
         self.stream.height = shape[1]
+        self.stream.thread_count = threads
+        self.stream.thread_type = thread_type
+        # libx264・libx265のオプション
+        options = {}
+        if preset is not None:
+            options["preset"] = preset
+        if crf is not None:
+            options["crf"] = str(crf)
+        else:
+            self.stream.bit_rate = bit_rate
+        self.stream.options = options
 
-    def write(self, image_rgb):
+        # エンコードスレッド
+        self._error = None
+        self._queue = None
+        self._thread = None
+        if background:
+            self._queue = queue.Queue(queue_size)
+            self._thread = threading.Thread(target=self._encode_loop, daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.release()
+            return
+        # ブロック内の例外を優先して送出する
+        try:
+            self.release()
+        except Exception:
+            pass
+
+    def write(self, image):
         """書き込み関数
 
         Args:
-            image_rgb (ndarray((height, width, 3), dtype=np.uint8)):
-                画像オブジェクト(RGB)
+            image (ndarray):
+                画像オブジェクト(input_formatの形式)
+                rgb24, bgr24の場合は ndarray((height, width, 3), dtype=np.uint8)、
+                yuv420pの場合は ndarray((height * 3 // 2, width), dtype=np.uint8)
 
         Returns:
             なし
+
+        Raises:
+            エンコードスレッドで発生した例外
         """
-        frame = av.VideoFrame.from_ndarray(image_rgb, format='rgb24')
-        packet = self.stream.encode(frame)
-        self.writer.mux(packet)
+        self._raise_error()
+        # 画像はフレームにコピーされるため、呼び出し側は戻った後に画像を再利用してよい
+        frame = av.VideoFrame.from_ndarray(image, format=self.input_format)
+        if self._thread is None:
+            self._encode(frame)
+        else:
+            self._queue.put(frame)
 
     def release(self):
         """書き込み終了
+
+        エンコード待ちのフレームをすべて書き込んでからファイルを閉じる
+
+        Raises:
+            エンコードスレッドで発生した例外
         """
-        if self.writer is not None:
+        if self.writer is None:
+            return
+        try:
+            if self._thread is not None:
+                self._queue.put(_END)
+                self._thread.join()
+                self._thread = None
+            self._raise_error()
             # flush
-            packet = self.stream.encode(None)
-            self.writer.mux(packet)
+            self._encode(None)
+        finally:
             # close
             self.writer.close()
             self.writer = None
 
+    def _encode(self, frame):
+        """1フレームのエンコードと書き込み
+
+        Args:
+            frame (av.VideoFrame or None): フレーム(Noneの場合はエンコーダーに残っているフレームを出力する)
+        """
+        start = time.perf_counter()
+        for packet in self.stream.encode(frame):
+            self.writer.mux(packet)
+        if self.metrics is not None and frame is not None:
+            self.metrics.add(STAGE, time.perf_counter() - start)
+
+    def _encode_loop(self):
+        """エンコードスレッド本体
+        """
+        while True:
+            frame = self._queue.get()
+            if frame is _END:
+                return
+            if self._error is not None:
+                # エラー後は書き込まずに読み捨て、呼び出し側が止まらないようにする
+                continue
+            try:
+                self._encode(frame)
+            except Exception as e:
+                self._error = e
+
+    def _raise_error(self):
+        """エンコードスレッドで発生した例外の送出
+        """
+        if self._error is not None:
+            raise self._error
+
     def __del__(self):
-        self.release()
+        try:
+            self.release()
+        except Exception:
+            pass
+
+
+def concat_videos(list_filenames, filename):
+    """動画ファイルの連結
+
+    再エンコードせずにパケットをそのまま連結する。
+    連結する動画は、同じ設定の VideoWriter で作成されている必要がある。
+
+    Args:
+        list_filenames (list(str)): 連結する動画ファイル名(連結順)
+        filename (str): 出力する動画ファイル名
+
+    Returns:
+        なし
+    """
+    writer = av.open(filename, "w")
+    try:
+        out_stream = None
+        # 連結済みの長さ[秒]
+        offset = Fraction(0)
+        for src in list_filenames:
+            reader = av.open(src)
+            try:
+                in_stream = reader.streams.video[0]
+                if out_stream is None:
+                    out_stream = writer.add_stream(template=in_stream)
+                time_base = in_stream.time_base
+                shift = int(offset / time_base)
+                end = 0
+                for packet in reader.demux(in_stream):
+                    # demuxの最後に返る空のパケットは除く
+                    if packet.dts is None:
+                        continue
+                    end = max(end, packet.pts + packet.duration)
+                    packet.pts += shift
+                    packet.dts += shift
+                    packet.stream = out_stream
+                    writer.mux(packet)
+                offset += end * time_base
+            finally:
+                reader.close()
+    finally:
+        writer.close()